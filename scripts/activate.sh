@@ -16,6 +16,7 @@ source "$venv_name/bin/activate"
 pip3 install --upgrade git+https://github.com/EchterAlsFake/PHUB
 pip install ffmpeg_progress_yield
 pip3 install BeautifulSoup4
+pip3 install lxml
 pip3 install validators
 pip3 install flask
 pip3 install flask-socketio
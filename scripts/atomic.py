@@ -0,0 +1,21 @@
+import threading
+import os
+
+from contextlib import contextmanager
+
+@contextmanager
+def atomic_write(filename):
+    """Open filename for writing through a temp file that only replaces it once it is complete.
+
+    Readers and a restart after a crash see either the old file or the new one, never half of it.
+    Every writer gets its own temp file, so two writing the same file at once cant move each other's away.
+    """
+    temp_file = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_file, 'w') as file:
+            yield file
+        os.replace(temp_file, filename)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
@@ -0,0 +1,140 @@
+import threading
+import json
+import time
+import os
+
+from datetime import datetime
+
+# how long a site can go without asking for bandwidth before its share goes to the others
+IdleAfter = 2.0
+
+# read size while a limit is active. streams take turns in chunks this big, which is what
+# keeps one stream with big reads from getting more than its share
+LimitedChunk = 64 * 1024
+
+def parse_clock(value):
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+def in_window(window, minute_of_day):
+    start = parse_clock(window['start'])
+    end = parse_clock(window['end'])
+    if start <= end:
+        return start <= minute_of_day < end
+    # wraps past midnight, e.g. 23:00 - 07:00
+    return minute_of_day >= start or minute_of_day < end
+
+def mbit_to_bytes(limit_mbit):
+    # 0 or null means no limit
+    if limit_mbit is None or limit_mbit <= 0:
+        return None
+    return limit_mbit * 1000 * 1000 / 8
+
+class TokenBucket:
+    """Hands out bytes at rate per second.
+
+    A reservation may take the bucket negative; the caller then sleeps off the
+    debt outside the lock. Waiters are served in the order they reserved, so
+    streams asking in equal sized chunks get an equal share. Starts empty, so
+    a site that just started cant burst past the cap or the share of the others.
+    """
+    def __init__(self, rate):
+        self.Rate = rate
+        self.Tokens = 0
+        self.Updated = time.monotonic()
+
+    def refill(self, now):
+        # at most a second worth of burst
+        self.Tokens = min(self.Rate, self.Tokens + (now - self.Updated) * self.Rate)
+        self.Updated = now
+
+    def set_rate(self, rate, now):
+        self.refill(now)
+        self.Rate = rate
+
+    def reserve(self, count, now):
+        self.refill(now)
+        self.Tokens -= count
+        if self.Tokens >= 0:
+            return 0
+        return -self.Tokens / self.Rate
+
+class BandwidthLimiter:
+    """Shares one bandwidth cap between every running download.
+
+    The cap comes from a JSON config file and can change with the time of day.
+    Every site that is currently downloading gets a slice of the cap in
+    proportion to its weight, and the streams of one site split that slice.
+    The file is re-read when it changes, so the schedule can be edited while
+    downloads are running. Without a file, or outside every window, there is
+    no limit at all.
+    """
+    def __init__(self, config_file):
+        self.ConfigFile = config_file
+        self.Config = {}
+        self.Buckets = {}
+        self.LastSeen = {}
+        self.lock = threading.Lock()
+        self.config_mtime = None
+        self.config_checked = 0
+
+    def load_config(self, now):
+        # checking the mtime on every chunk would cost more than the limiting itself
+        if now - self.config_checked < 5:
+            return
+        self.config_checked = now
+        try:
+            mtime = os.path.getmtime(self.ConfigFile)
+            if mtime == self.config_mtime:
+                return
+            with open(self.ConfigFile, 'r') as json_file:
+                self.Config = json.load(json_file)
+            self.config_mtime = mtime
+            print(f"[Bandwidth] Loaded {self.ConfigFile}")
+        except FileNotFoundError:
+            self.Config = {}
+            self.config_mtime = None
+        except json.decoder.JSONDecodeError:
+            print(f"[Bandwidth] {self.ConfigFile} has invalid JSON. Keeping the previous limits.")
+            self.config_mtime = mtime
+
+    def current_limit(self):
+        """Bytes per second allowed right now, or None for unlimited."""
+        moment = datetime.now()
+        minute_of_day = moment.hour * 60 + moment.minute
+        for window in self.Config.get('schedule', []):
+            if in_window(window, minute_of_day):
+                return mbit_to_bytes(window.get('limit_mbit'))
+        return mbit_to_bytes(self.Config.get('default_limit_mbit'))
+
+    def weight(self, site):
+        return max(0.01, float(self.Config.get('weights', {}).get(site, 1)))
+
+    def acquire(self, site, count):
+        """Block until count bytes for site fit under the cap. Returns whether a limit is active."""
+        with self.lock:
+            now = time.monotonic()
+            self.load_config(now)
+            limit = self.current_limit()
+            self.LastSeen[site] = now
+            if limit is None:
+                return False
+
+            # share the cap between the sites that are actually downloading right now
+            active = [active_site for active_site, seen in self.LastSeen.items() if now - seen < IdleAfter]
+            rate = limit * self.weight(site) / sum(self.weight(active_site) for active_site in active)
+
+            bucket = self.Buckets.get(site)
+            if bucket is None:
+                bucket = TokenBucket(rate)
+                self.Buckets[site] = bucket
+            bucket.set_rate(rate, now)
+            wait = bucket.reserve(count, now)
+
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def throttle(self, site):
+        """A callable for one site that transfer code can call with each chunk size."""
+        return lambda count: self.acquire(site, count)
@@ -0,0 +1,51 @@
+import tracemalloc
+import argparse
+import time
+import os
+
+from vrp_scrape import VRP_Page
+from vrp_scrape import HTMLParser
+
+# compares the full html.parser tree VRP_Page used to build against the targeted parse.
+# save a few video pages from a logged in browser session into a folder and point this at it
+parser = argparse.ArgumentParser(description="Benchmark VRP page parsing over saved sample pages.")
+parser.add_argument("-i", "--input-dir", help="Directory of saved VRP video pages (.html)", required=True)
+parser.add_argument("-n", "--repeat", help="How many times each page is parsed for timing", type=int, default=20)
+
+def measure(text, targeted, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        VRP_Page("", None).parse(text, targeted=targeted)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    VRP_Page("", None).parse(text, targeted=targeted)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+def main():
+    args = parser.parse_args()
+    pages = sorted(entry for entry in os.listdir(args.input_dir) if entry.endswith(".html"))
+    if len(pages) == 0:
+        print(f"No .html files found in {args.input_dir}")
+        return
+
+    print(f"Targeted parser backend: {HTMLParser}")
+    print(f"{'page':<40} {'full ms':>10} {'full MB':>10} {'targeted ms':>12} {'targeted MB':>12}")
+    totals = [0, 0, 0, 0]
+    for page in pages:
+        with open(os.path.join(args.input_dir, page), 'r', encoding='utf-8') as file:
+            text = file.read()
+
+        full_time, full_peak = measure(text, False, args.repeat)
+        targeted_time, targeted_peak = measure(text, True, args.repeat)
+        row = [full_time * 1000, full_peak / 1e6, targeted_time * 1000, targeted_peak / 1e6]
+        totals = [total + value for total, value in zip(totals, row)]
+        print(f"{page[:40]:<40} {row[0]:10.2f} {row[1]:10.2f} {row[2]:12.2f} {row[3]:12.2f}")
+
+    averages = [total / len(pages) for total in totals]
+    print(f"{'average':<40} {averages[0]:10.2f} {averages[1]:10.2f} {averages[2]:12.2f} {averages[3]:12.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import http.server
+import multiprocessing
+import argparse
+import requests
+import tempfile
+import time
+import os
+import re
+
+from tqdm import tqdm
+
+from progress import ProgressTracker
+
+from transfer import RangeDownloader
+from transfer import StreamHeaders
+from transfer import stream_into
+
+# compares the old iter_content write loop against the buffered stream_into path.
+# the server runs in its own process so its cpu time is not counted against the client
+parser = argparse.ArgumentParser(description="Benchmark the download write path against a local HTTP server.")
+parser.add_argument("-s", "--size-mb", help="Size of the test file in MB", type=int, default=1024)
+parser.add_argument("-p", "--port", help="Port for the local test server", type=int, default=8765)
+parser.add_argument("-o", "--output-dir", help="Where to write the downloaded test files", default=None)
+
+def serve(port, size):
+    block = os.urandom(1024 * 1024)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            start, end = 0, size - 1
+            match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+
+            remaining = end - start + 1
+            while remaining > 0:
+                count = min(remaining, len(block))
+                self.wfile.write(block[:count])
+                remaining -= count
+
+    http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler).serve_forever()
+
+def old_path(url, destination):
+    response = requests.get(url, stream=True)
+    total_size = int(response.headers.get('content-length', 0))
+    with open(destination, 'wb') as file, tqdm(total=total_size, unit='B', unit_scale=True, unit_divisor=1024, disable=None) as bar:
+        for chunk in response.iter_content(chunk_size=1024):
+            file.write(chunk)
+            bar.update(len(chunk))
+
+def new_path(url, destination):
+    response = requests.get(url, headers=StreamHeaders, stream=True)
+    total_size = int(response.headers.get('content-length', 0))
+    with open(destination, 'wb') as file, response, ProgressTracker().start(os.path.basename(destination), total=total_size) as progress:
+        stream_into(response, file, bytearray(1024 * 1024), progress.add)
+
+def segmented_path(url, destination):
+    RangeDownloader(segments=4, segment_size=64 * 1024 * 1024).download(url, destination)
+
+def measure(name, fn, url, destination, size):
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    fn(url, destination)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    os.remove(destination)
+
+    gigabytes = size / 1e9
+    return f"{name:<12} {size / 1e6 / wall:10.1f} MB/s {cpu / gigabytes:10.2f} cpu s/GB"
+
+def main():
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+    url = f"http://127.0.0.1:{args.port}/bench.bin"
+
+    server = multiprocessing.Process(target=serve, args=(args.port, size), daemon=True)
+    server.start()
+    time.sleep(0.5)
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(dir=args.output_dir) as temp_dir:
+            destination = os.path.join(temp_dir, "bench.bin")
+            results.append(measure("before", old_path, url, destination, size))
+            results.append(measure("after", new_path, url, destination, size))
+            results.append(measure("segmented", segmented_path, url, destination, size))
+    finally:
+        server.terminate()
+
+    print(f"Downloaded {args.size_mb} MB from a local server")
+    for line in results:
+        print(line)
+
+if __name__ == "__main__":
+    main()
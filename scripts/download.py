@@ -1,12 +1,13 @@
 
-import validators
 import subprocess
-import tempfile
+import errno
+import threading
 import argparse
 import requests
 import shutil
 import json
 import phub
+import time
 import re
 import os
 
@@ -16,26 +17,183 @@ from phub import Quality
 from vrp_scrape import VRP_Page
 from vrp_scrape import VRP_VideoData
 from vrp_scrape import VRP_Authenticate
+from vrp_scrape import VRP_PageCache
+
+from transfer import RangeDownloader
+from transfer import HLSDownloader
+
+from progress import ProgressTracker
+
+from bandwidth import BandwidthLimiter
+
+from quality import QualityPolicy
+from quality import Option
+from quality import parse_height
+from quality import estimate_size
+from quality import InsufficientSpace
+
+from retry import RetryPolicy
+from retry import is_retriable
+from retry import backoff
+
+from metrics import MetricsRegistry
+
+from ledger import DownloadLedger
+from ledger import canonical_video_id
+
+from mux import mux_video
+from mux import mux_streaming
+
+from scheduler import Pipeline
+from scheduler import Stage
+from scheduler import prefetch
+
+from jobs import JobStore
+from jobs import JobCancelled
+from jobs import classify_url
+from jobs import DOWNLOADING, MUXING, DONE, FAILED, RETRYING
+
+from log_tailer import DirectoryWatch
 
 from pytubefix import YouTube
 from pytubefix import Playlist
 from pytubefix import exceptions
 
+from threading import Thread
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from collections import namedtuple
 from html import unescape
 from xml.etree import ElementTree
 
 VideoFileData = namedtuple('VideoFileData', ['Filename', 'SubFolder', 'File'])
+SubtitleFileData = namedtuple('SubtitleFileData', ['File', 'Language', 'Name'])
 
 parser = argparse.ArgumentParser(description="Verify and save valid URLs from a file.")
-parser.add_argument("-i", "--filename", help="Input file containing 1 URL per line", required=True)
+parser.add_argument("-i", "--filename", help="Input file containing 1 URL per line", required=False)
 parser.add_argument("-c", "--config-dir", help="Directory containing config files. VRP requires a ./vrp_cookie_cache and a ./vrp_credentials file", required=True)
+parser.add_argument("--daemon", help="Stay resident and process every file that lands in --watch-dir", action="store_true")
+parser.add_argument("-w", "--watch-dir", help="Directory to watch for new URL files when running with --daemon", required=False)
+parser.add_argument("-d", "--done-dir", help="Directory processed URL files are moved into when running with --daemon", required=False)
+parser.add_argument("--progress-file", help="JSON file the progress of running downloads is written to for the web server", required=False)
+parser.add_argument("--metrics-file", help="File the download metrics are written to in the Prometheus text format for the web server", required=False)
 GlobalArgs = parser.parse_args()
 
+if GlobalArgs.daemon and (GlobalArgs.watch_dir is None or GlobalArgs.done_dir is None):
+    parser.error("--daemon requires --watch-dir and --done-dir")
+if not GlobalArgs.daemon and GlobalArgs.filename is None:
+    parser.error("--filename is required unless running with --daemon")
+
 # use this to move files into a given path
-output_path_config = ""
-def move_video(video_data, output_path):
+output_path_config = f"{GlobalArgs.config_dir}/output_paths"
+
+# tunables that live in ./config/settings. anything missing from the file falls back to these
+settings_config = f"{GlobalArgs.config_dir}/settings"
+DefaultSettings = {
+    "concurrency": {
+        "pornhub": 2,
+        "vrporn": 1,
+        "youtube": 2,
+    },
+    "transfer": {
+        "segments": 4,
+        "segment_size_mb": 64,
+        "buffer_kb": 1024,
+    },
+    "youtube": {
+        "playlist_prefetch": 4,
+        "parallel_parts": 4,
+        "streaming_mux": False,
+    },
+    "staging": {
+        "pornhub": "",
+        "vrporn": "",
+        "youtube": "",
+    },
+    "vrp": {
+        "pool_size": 16,
+        "auth_ttl": 6 * 60 * 60,
+        "page_cache_ttl": 60 * 60,
+        "link_ttl": 4 * 60 * 60,
+    },
+    "progress": {
+        "milestone_percent": 25,
+    },
+    "quality": {
+        "min_free_gb": 2,
+        "max_size_gb": {
+            "pornhub": 0,
+            "vrporn": 10,
+            "youtube": 0,
+        },
+        "max_height": {
+            "pornhub": 0,
+            "vrporn": 0,
+            "youtube": 0,
+        },
+    },
+    "retry": {
+        "attempts": 5,
+        "base_delay": 1,
+        "max_delay": 60,
+        "breaker_threshold": 5,
+        "breaker_cooldown": 30,
+        "breaker_max_cooldown": 15 * 60,
+        "job_attempts": 5,
+        "job_delay": 5 * 60,
+        "job_max_delay": 6 * 60 * 60,
+    },
+    "pipeline": {
+        "resolve": {
+            "pornhub": 1,
+            "vrporn": 1,
+            "youtube": 1,
+        },
+        "postprocess": 2,
+        "queue_size": 2,
+    },
+}
+
+def load_settings():
+    settings = json.loads(json.dumps(DefaultSettings))
+    try:
+        with open(settings_config, 'r') as json_file:
+            loaded = json.load(json_file)
+    except FileNotFoundError:
+        print(f"{settings_config} not found. Using defaults.")
+        return settings
+    except json.decoder.JSONDecodeError:
+        print(f"{settings_config} has invalid JSON. Using defaults.")
+        return settings
+
+    # merge one level deep so a partial section keeps the other defaults
+    for section, values in loaded.items():
+        if isinstance(values, dict) and isinstance(settings.get(section), dict):
+            settings[section].update(values)
+        else:
+            settings[section] = values
+    return settings
+
+Settings = load_settings()
+
+# numbers for server.py's /metrics. the downloader writes them to --metrics-file every few seconds
+Sites = ["pornhub", "vrporn", "youtube"]
+metrics = MetricsRegistry()
+bytes_downloaded = metrics.counter("downloader_bytes_total", "Bytes downloaded.", ["site"])
+metrics.throughput("downloader_throughput_bytes_per_second", "Download throughput over the last few seconds.", bytes_downloaded)
+phase_seconds = metrics.histogram("downloader_phase_seconds", "Time spent in each phase of a download.", ["phase", "site"])
+failures = metrics.counter("downloader_failures_total", "Videos that failed or were skipped, by exception class.", ["site", "reason"])
+jobs_running = metrics.gauge("downloader_jobs_running", "Jobs currently being worked on.", ["site"])
+for site in Sites:
+    bytes_downloaded.inc(0, site=site)
+    jobs_running.set(0, site=site)
+if GlobalArgs.metrics_file is not None:
+    metrics.start_writer(GlobalArgs.metrics_file)
+
+def count_failure(site, error):
+    failures.inc(site=site, reason=type(error).__name__)
+
+def move_video(video_data, output_path, site=""):
     if output_path == "":
         print(f"Path is empty.  Please configure \"{output_path_config}\"")
         return
@@ -50,10 +208,141 @@ def move_video(video_data, output_path):
         print(f"Creating: {final_path}")
         os.makedirs(final_path)
 
-    # move the file to our target dir
+    # move the file to our target dir. staging shares the filesystem so this is a single atomic rename
     final_final = f"{final_path}/{video_data.Filename}"
     print(f"Moving to: {final_final}")
-    shutil.move(video_data.File, final_final)
+    with phase_seconds.time(phase="move", site=site):
+        try:
+            os.replace(video_data.File, final_final)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            print(f"[Move] {video_data.File} is on another filesystem, copying instead of renaming")
+            shutil.move(video_data.File, final_final)
+    return final_final
+
+# every finished download is recorded here so re-submitted videos are skipped before any network work
+ledger = DownloadLedger(f"{GlobalArgs.config_dir}/ledger.db")
+
+# urls submitted through server.py or dropped in the watch folder are queued here and claimed by the daemon
+jobs = JobStore(f"{GlobalArgs.config_dir}/jobs.db")
+
+def set_job_state(job_id, state):
+    # grabs started from a -i file have no job. raises JobCancelled if the job was cancelled
+    if job_id is not None:
+        jobs.set_state(job_id, state)
+
+def check_cancelled(job_id):
+    if job_id is not None and jobs.is_cancelled(job_id):
+        raise JobCancelled(f"Job {job_id} was cancelled")
+
+def is_downloaded(site, url):
+    video_id = canonical_video_id(site, url)
+    if ledger.contains(site, video_id):
+        print(f"[Ledger] Skipping already downloaded {site} video: {url}")
+        return True
+    return False
+
+# partial downloads are kept here between runs so they can be resumed after a restart.
+# it has to be on the same filesystem as the output path so finishing a download is a rename, not a copy
+def get_staging_dir(site, destination_dir):
+    os.makedirs(destination_dir, exist_ok=True)
+    staging_dir = f"{destination_dir}/.staging"
+
+    configured_dir = Settings["staging"].get(site, "")
+    if configured_dir != "":
+        os.makedirs(configured_dir, exist_ok=True)
+        if os.stat(configured_dir).st_dev == os.stat(destination_dir).st_dev:
+            staging_dir = configured_dir
+        else:
+            print(f"[Staging] {configured_dir} is not on the same filesystem as {destination_dir}. Using {staging_dir}")
+
+    os.makedirs(staging_dir, exist_ok=True)
+    return staging_dir
+
+# transfers report here instead of printing per chunk. the log only gets milestone lines
+def count_bytes(site, count):
+    bytes_downloaded.inc(count, site=site if site is not None else "unknown")
+
+progress_tracker = ProgressTracker(GlobalArgs.progress_file, milestone=Settings["progress"]["milestone_percent"], on_bytes=count_bytes)
+
+# every transfer path shares this cap. the file is re-read when it changes, so limits can be edited while running
+bandwidth = BandwidthLimiter(f"{GlobalArgs.config_dir}/bandwidth")
+
+class JobBandwidth:
+    """The shared limiter for the transfers of one job, which also stops them once the job is cancelled.
+
+    Every chunk passes through the throttle, so that is where the job store is
+    asked, at most once a second.
+    """
+    def __init__(self, job_id):
+        self.JobId = job_id
+        self.checked_at = time.monotonic()
+
+    def throttle(self, site):
+        acquire = bandwidth.throttle(site)
+        def throttle(count):
+            now = time.monotonic()
+            if now - self.checked_at >= 1.0:
+                self.checked_at = now
+                check_cancelled(self.JobId)
+            return acquire(count)
+        return throttle
+
+def get_bandwidth(job_id):
+    # grabs started from a -i file have no job to cancel
+    return JobBandwidth(job_id) if job_id is not None else bandwidth
+
+# every network call goes through this. a host that rate limits us is paused for every worker at once
+retry_settings = Settings["retry"]
+retry_policy = RetryPolicy(retry_settings["attempts"], retry_settings["base_delay"], retry_settings["max_delay"],
+                           retry_settings["breaker_threshold"], retry_settings["breaker_cooldown"], retry_settings["breaker_max_cooldown"])
+
+def should_retry(error):
+    # a full disk may have room again by the next attempt
+    return is_retriable(error) or isinstance(error, InsufficientSpace)
+
+def queue_retry(url, error, job_id=None):
+    """Put a url that failed with a retriable error back in the job store for a later attempt."""
+    message = f"{type(error).__name__}: {error}"
+    if job_id is None:
+        # a new job goes in already waiting, so the daemon cant claim it before it is due
+        if retry_settings["job_attempts"] > 1:
+            state, retry_at = RETRYING, time.time() + backoff(0, retry_settings["job_delay"], retry_settings["job_max_delay"])
+        else:
+            state, retry_at = FAILED, None
+        ids, _ = jobs.add([url], state=state, retry_at=retry_at, attempts=1, error=message)
+        if len(ids) == 0:
+            return
+        job_id = ids[0]
+    else:
+        state = jobs.retry(job_id, message, retry_settings["job_delay"], retry_settings["job_max_delay"], retry_settings["job_attempts"])
+    if state == RETRYING:
+        print(f"[Retry] Job {job_id} will be tried again later: {url}")
+    else:
+        print(f"[Retry] Job {job_id} failed after {retry_settings['job_attempts']} attempts: {url}")
+
+def retry_playlist_video(url, error, site="youtube"):
+    """Queue a playlist video that failed with a retriable error as a job of its own. Returns whether it was queued."""
+    # the playlist job is done once any of its videos made it, so one that keeps failing is retried on its own
+    if not should_retry(error):
+        return False
+    print(f"[Youtube] Failed grabbing {url}: {type(error).__name__}: {error}")
+    count_failure(site, error)
+    queue_retry(url, error)
+    return True
+
+# every resolved video reserves its size on the output volume until it is moved into place
+quality_policy = QualityPolicy(Settings["quality"])
+
+def release_space(task):
+    if task.Reservation is not None:
+        task.Reservation.release()
+        task.Reservation = None
+
+def get_range_downloader(site, job_id=None):
+    transfer = Settings["transfer"]
+    return RangeDownloader(segments=transfer["segments"], segment_size=transfer["segment_size_mb"] * 1024 * 1024, buffer_size=transfer["buffer_kb"] * 1024, progress=progress_tracker, site=site, bandwidth=get_bandwidth(job_id), retry=retry_policy)
 
 def detox_filename(filename):
     filename = re.sub(r'[^\w\s-]', '', filename)    
@@ -62,328 +351,750 @@ def detox_filename(filename):
     
     return filename
 
-def progress(param):
-    print(param)
-    
-def GrabPH(urls, destination_dir):
-    client = phub.Client()
-    for url in urls:
-        video = client.get(url) 
+# clients are created on first use and kept alive for the lifetime of the process
+# so the daemon doesnt pay for a new phub session or a VRP login check on every file
+# the lock keeps concurrent site workers from racing to create them
+ph_client = None
+vrp_auth = None
+client_lock = threading.Lock()
 
-        subfolder = f"{detox_filename(video.author.name)}"
-        final_name = f"{detox_filename(video.title)}.mp4"
-        
-        # grab the file into our temp path
-        print(f"[PH] Grabbing: {video.title}")
-        temp_file = f"{destination_dir}/{final_name}"
-        saved_file = video.download(path = temp_file, quality = Quality.BEST)
+def get_ph_client():
+    global ph_client
+    with client_lock:
+        if ph_client is None:
+            ph_client = phub.Client()
+        return ph_client
+
+vrp_credentials_filename = f"{GlobalArgs.config_dir}/vrp_credentials"
+vrp_cookie_cache_filename = f"{GlobalArgs.config_dir}/vrp_cookie_cache"
 
-        move_video(VideoFileData(Filename=final_name, SubFolder=subfolder, File=saved_file), destination_dir)
+# scraped pages are kept here so re-submitted urls dont have to be scraped again
+vrp_page_cache = None
 
-def GrabVRP(urls, destination_dir):
+def get_vrp_page_cache():
+    global vrp_page_cache
+    with client_lock:
+        if vrp_page_cache is None:
+            vrp_page_cache = VRP_PageCache(f"{GlobalArgs.config_dir}/vrp_page_cache", Settings["vrp"]["page_cache_ttl"], Settings["vrp"]["link_ttl"])
+        return vrp_page_cache
 
-    credentials_filename = f"{GlobalArgs.config_dir}/vrp_credentials"
-    cookie_cache_filename = f"{GlobalArgs.config_dir}/vrp_cookie_cache"
+def get_vrp_auth():
+    with client_lock:
+        return create_vrp_auth()
+
+def create_vrp_auth():
+    global vrp_auth
+    if vrp_auth is not None:
+        return vrp_auth
 
     # load in our credentials and authenticate
     auth_credentials = {}
     try:
-        with open(credentials_filename, 'r') as json_file:
+        with open(vrp_credentials_filename, 'r') as json_file:
             auth_credentials = json.load(json_file)
     except FileNotFoundError:
-        print(f"[vrp] {credentials_filename} not found.")
-        return []
+        print(f"[vrp] {vrp_credentials_filename} not found.")
+        return None
+
+    auth = VRP_Authenticate(auth_credentials['username'], auth_credentials['password'], pool_size=Settings["vrp"]["pool_size"], retry=retry_policy)
+    auth.LoadCookies(vrp_cookie_cache_filename)
+
+    # a login confirmed within the ttl is trusted without another /account round trip
+    if auth.IsValidationFresh(Settings["vrp"]["auth_ttl"]):
+        print("[vrp] Using cached login")
+    elif not validate_vrp_auth(auth):
+        return None
 
-    vrp_auth = VRP_Authenticate(auth_credentials['username'], auth_credentials['password'])
-    vrp_auth.LoadCookies(cookie_cache_filename)
+    vrp_auth = auth
+    return vrp_auth
 
+def validate_vrp_auth(auth):
     # ensure we are authenticated
-    if not vrp_auth.IsAuthenticated():
-        if vrp_auth.Authenticate():
-            vrp_auth.SaveCookies(cookie_cache_filename)
-        else:
-            return []
-    
-    for url in urls:
-        video_page = VRP_Page(url, vrp_auth)
-        video_page.obtain()
-
-        target = video_page.find_largest_under_limit("10 GB")
-        if target is not None:
-            print(f"[VRP]Grabbing: {video_page.Name}({target.Quality})")
-            filename = f"{detox_filename(video_page.Name)}-{detox_filename(target.Quality)}.mp4"
-            subfolder = f"{detox_filename(video_page.Author)}"
-            target_file = f"{destination_dir}/{filename}"
-            target.download_file_with_progress(target_file)
-
-            move_video(VideoFileData(Filename=filename, SubFolder=subfolder, File=target_file), destination_dir)
-        else:
-            print(f"Unable to grab video from: {url}")
-
-def GrabYT(urls, destination_dir):
-    def on_video_download(stream, chunk, file_handle, bytes_remaining):
-        total_size = stream.filesize
-        bytes_downloaded = total_size - bytes_remaining
-        percentage = (bytes_downloaded / total_size) * 100
-
-        file_handle.write(chunk)
-        print(f"[Youtube] Downloading Video \"{stream.title}\" Progress: {percentage:.2f}%")
-
-    def on_audio_download(stream, chunk, file_handle, bytes_remaining):
-        total_size = stream.filesize
-        bytes_downloaded = total_size - bytes_remaining
-        percentage = (bytes_downloaded / total_size) * 100
-
-        file_handle.write(chunk)
-        print(f"[Youtube] Downloading Audio \"{stream.title}\" Progress: {percentage:.2f}%")
-
-    def xml_caption_to_srt(self, xml_captions: str) -> str:
-        """Convert xml caption tracks to "SubRip Subtitle (srt)".
-
-        :param str xml_captions:
-        XML formatted caption tracks.
-        """
-        segments = []
-        root = ElementTree.fromstring(xml_captions)
-        i=0
-        for child in root:
-            if child.tag == 'text':
-                caption = ''
-                if len(list(child))==0:
-                    # instead of 'continue'
-                    caption = child.text
-                    if caption is None:
-                        caption = ""
-                for s in list(child):
-                    if s.tag == 's':
-                        caption += ' ' + s.text
-                caption = unescape(caption.replace("\n", " ").replace("  ", " "),)
-                try:
-                    duration = float(child.attrib["dur"])
-                except KeyError:
-                    duration = 0.0
-                start = float(child.attrib["start"])
-                end = start + duration
-                sequence_number = i + 1  # convert from 0-indexed to 1.
-                line = "{seq}\n{start} --> {end}\n{text}\n".format(
-                    seq=sequence_number,
-                    start=self.float_to_srt_time_format(start),
-                    end=self.float_to_srt_time_format(end),
-                    text=caption,
-                )
-                segments.append(line)
-                i += 1
-        return "\n".join(segments).strip()
-
-    grabbed_files = []
-    for url in urls:
+    if auth.IsAuthenticated() or auth.Authenticate():
+        auth.SaveCookies(vrp_cookie_cache_filename)
+        return True
+    return False
+
+def refresh_vrp_auth(auth, since):
+    with client_lock:
+        # another worker may have already re-validated after our page was fetched
+        if auth.ValidatedAt is not None and auth.ValidatedAt > since:
+            return True
+        auth.Invalidate()
+        return validate_vrp_auth(auth)
+
+class GrabTask:
+    """One video on its way through the pipeline. Each stage fills in what the next one needs."""
+    def __init__(self, site, url, destination_dir, job_id=None):
+        self.Site = site
+        self.Url = url
+        self.DestinationDir = destination_dir
+        self.JobId = job_id
+        self.VideoId = canonical_video_id(site, url)
+        self.Name = url
+        self.Source = None      # phub video, VRP download link or YouTube object
+        self.FinalName = None
+        self.SubFolder = None
+        self.File = None        # staged file the post-processing moves into place
+        self.TempDir = None     # removed once the video is in place
+        self.Parts = None       # youtube video, audio and subtitles that still need muxing
+        self.Quality = None     # pornhub height picked by the quality policy
+        self.Playlist = False   # found in a playlist, so it is retried as a job of its own
+        self.Reservation = None # disk space held for this video until it is in place
+
+def FinishGrab(task):
+    # the transfer may have finished just as the job was cancelled, dont move it into place then
+    check_cancelled(task.JobId)
+    final_file = move_video(VideoFileData(Filename=task.FinalName, SubFolder=task.SubFolder, File=task.File), task.DestinationDir, task.Site)
+    ledger.record(task.Site, task.VideoId, final_file)
+    if task.TempDir is not None:
+        shutil.rmtree(task.TempDir, ignore_errors=True)
+    return [final_file]
+
+def get_ph_options(video):
+    # HLS has no size up front, so the policy works with an estimate from the duration
+    seconds = video.duration.total_seconds()
+    heights = sorted({int(definition['quality']) for definition in video.fetch('page@mediaDefinitions') if str(definition['quality']).isdigit()})
+    if len(heights) == 0:
+        return [Option("best", None, 0, Quality.BEST)]
+    return [Option(f"{height}p", height, estimate_size(height, seconds), height) for height in heights]
+
+def ResolvePH(task):
+    client = get_ph_client()
+    with phase_seconds.time(phase="scrape", site="pornhub"):
+        video = client.get(task.Url) 
+        options = retry_policy.call(task.Url, get_ph_options, video)
+
+    option, task.Reservation = quality_policy.choose("pornhub", task.DestinationDir, options)
+    if option is None:
+        print(f"Unable to grab video from: {task.Url}")
+        return None
+
+    task.Source = video
+    task.Quality = option.Source
+    task.Name = video.title
+    task.SubFolder = f"{detox_filename(video.author.name)}"
+    task.FinalName = f"{detox_filename(video.title)}.mp4"
+    return [task]
+
+def TransferPH(task):
+    # grab the file into our staging path. segments are appended as they arrive so a restart can resume
+    set_job_state(task.JobId, DOWNLOADING)
+    print(f"[PH] Grabbing: {task.Name}")
+    temp_file = f"{get_staging_dir('pornhub', task.DestinationDir)}/{task.FinalName}"
+    task.Reservation.track(temp_file)
+    with phase_seconds.time(phase="download", site="pornhub"):
+        task.File = task.Source.download(path = temp_file, quality = task.Quality, downloader = HLSDownloader(progress = progress_tracker, site = "pornhub", bandwidth = get_bandwidth(task.JobId), retry = retry_policy, workers = Settings["transfer"]["segments"]))
+    return [task]
+
+def ResolveVRP(task):
+    vrp_auth = get_vrp_auth()
+    if vrp_auth is None:
+        return None
+
+    page_cache = get_vrp_page_cache()
+    fetched_at = time.time()
+    video_page = VRP_Page(task.Url, vrp_auth)
+    with phase_seconds.time(phase="scrape", site="vrporn"):
+        video_page.obtain(page_cache)
+
+    # only logged out links means the cached login may have expired. check it once and try again
+    if video_page.SessionExpired:
+        print("[vrp] Page only has logged out links. Re-validating login")
+        if refresh_vrp_auth(vrp_auth, fetched_at):
+            video_page = VRP_Page(task.Url, vrp_auth)
+            with phase_seconds.time(phase="scrape", site="vrporn"):
+                video_page.obtain(page_cache)
+
+    options = [Option(link.Quality, link.Height, link.Bytes, link) for link in video_page.Links]
+    option, task.Reservation = quality_policy.choose("vrporn", task.DestinationDir, options)
+    if option is None:
+        print(f"Unable to grab video from: {task.Url}")
+        return None
+
+    target = option.Source
+    task.Source = target
+    task.Name = f"{video_page.Name}({target.Quality})"
+    task.FinalName = f"{detox_filename(video_page.Name)}-{detox_filename(target.Quality)}.mp4"
+    task.SubFolder = f"{detox_filename(video_page.Author)}"
+    return [task]
+
+def TransferVRP(task):
+    set_job_state(task.JobId, DOWNLOADING)
+    print(f"[VRP]Grabbing: {task.Name}")
+    task.File = f"{get_staging_dir('vrporn', task.DestinationDir)}/{task.FinalName}"
+    task.Reservation.track(task.File)
+    transfer = Settings["transfer"]
+    try:
+        with phase_seconds.time(phase="download", site="vrporn"):
+            task.Source.download_file_with_progress(task.File, segments=transfer["segments"], segment_size=transfer["segment_size_mb"] * 1024 * 1024, buffer_size=transfer["buffer_kb"] * 1024, progress=progress_tracker, bandwidth=get_bandwidth(task.JobId), retry=retry_policy)
+    except JobCancelled:
+        raise
+    except Exception:
+        # the cached link may have expired, make the next attempt scrape the page again
+        get_vrp_page_cache().remove(task.Url)
+        raise
+    return [task]
+
+def xml_caption_to_srt(track, xml_captions: str) -> str:
+    """Convert xml caption tracks to "SubRip Subtitle (srt)".
+
+    :param str xml_captions:
+    XML formatted caption tracks.
+    """
+    segments = []
+    root = ElementTree.fromstring(xml_captions)
+    i=0
+    for child in root:
+        if child.tag == 'text':
+            caption = ''
+            if len(list(child))==0:
+                # instead of 'continue'
+                caption = child.text
+                if caption is None:
+                    caption = ""
+            for s in list(child):
+                if s.tag == 's':
+                    caption += ' ' + s.text
+            caption = unescape(caption.replace("\n", " ").replace("  ", " "),)
+            try:
+                duration = float(child.attrib["dur"])
+            except KeyError:
+                duration = 0.0
+            start = float(child.attrib["start"])
+            end = start + duration
+            sequence_number = i + 1  # convert from 0-indexed to 1.
+            line = "{seq}\n{start} --> {end}\n{text}\n".format(
+                seq=sequence_number,
+                start=track.float_to_srt_time_format(start),
+                end=track.float_to_srt_time_format(end),
+                text=caption,
+            )
+            segments.append(line)
+            i += 1
+    return "\n".join(segments).strip()
+
+def fetch_subtitle(track, final_name, temp_dir):
+    try:
+        xml_captions = retry_policy.call(track.url, lambda: track.xml_captions)
+    except Exception as e:
+        print(f"[Youtube] Failed downloading subtitle track: {track.name}: {e}")
+        return None
+
+    if xml_captions == '':
+        print(f"[Youtube] Failed downloading subtitle track: {track.name}")
+        return None
+    print(f"[Youtube] Downloading subtitle track: {track.name}")
+
+    language_code = track.code
+    if language_code.startswith("a."):
+        language_code = language_code[2:]
+
+    srt_subtitles = xml_caption_to_srt(track, xml_captions)
+    srt_subtitles_file_name = f"{final_name}_subtitle_{track.code}.srt"
+
+    srt_subtitles_file = os.path.join(temp_dir, srt_subtitles_file_name)
+    with open(os.path.join(srt_subtitles_file), 'w', encoding='utf-8') as file:
+        file.write(srt_subtitles)
+
+    print(f"[Youtube] Subtitle track '{track.name}' downloaded and converted to {srt_subtitles_file}")
+    return SubtitleFileData(File=srt_subtitles_file, Language=language_code, Name=track.name)
+
+def stream_youtube_video(video, video_stream, audio_stream, temp_dir, final_name, job_id=None):
+    downloader = get_range_downloader("youtube", job_id)
+
+    # subtitles are small and ffmpeg needs them as files before it starts, so grab those first
+    with ThreadPoolExecutor(max_workers=Settings["youtube"]["parallel_parts"]) as pool:
+        subtitle_futures = [pool.submit(fetch_subtitle, track, final_name, temp_dir) for track in video.captions]
+    subtitles = [subtitle for subtitle in (future.result() for future in subtitle_futures) if subtitle is not None]
+
+    output_file = os.path.join(temp_dir, final_name)
+    print(f"[Youtube] Streaming Video and Audio into ffmpeg: {video.title}")
+    video_writer = partial(downloader.stream, video_stream.url, name=f"{final_name} (video)")
+    audio_writer = partial(downloader.stream, audio_stream.url, name=f"{final_name} (audio)")
+    with phase_seconds.time(phase="download", site="youtube"):
+        streamed = mux_streaming(video_writer, audio_writer, subtitles, output_file, temp_dir, reraise=(JobCancelled,))
+    if not streamed:
+        # ffmpeg may have failed first, a cancelled job still must not fall back to downloading the parts
+        check_cancelled(job_id)
+        return None
+    return output_file
+
+def resolve_youtube_video(video_url):
+    with phase_seconds.time(phase="scrape", site="youtube"):
+        return retry_policy.call(video_url, load_youtube_video, video_url)
+
+def resolve_playlist_video(video_url):
+    try:
+        return resolve_youtube_video(video_url)
+    except Exception as e:
+        if not retry_playlist_video(video_url, e):
+            raise
+        return None
+
+def load_playlist(playlist_url):
+    playlist = Playlist(playlist_url)
+    playlist.title
+    return playlist
+
+def load_youtube_video(video_url):
+    use_oauth = False
+    oauth_cache = False
+    video = YouTube(video_url + "&has_verified=1", use_oauth=use_oauth, allow_oauth_cache=oauth_cache)
+
+    # pull the metadata and stream list now so it happens on the prefetch pool.
+    # restricted videos raise here and are reported properly when the streams are picked,
+    # network trouble is raised so the whole lookup is tried again
+    try:
+        video.title
+        video.streams
+    except Exception as e:
+        if is_retriable(e):
+            raise
+    return video
+
+def ResolveYT(task):
+    playlist_path = None
+    if "list" in task.Url:
+        with phase_seconds.time(phase="scrape", site="youtube"):
+            playlist = retry_policy.call(task.Url, load_playlist, task.Url)
+        print(f"[Youtube] Found Playlist: {playlist.title}")
+        playlist_path = f"{detox_filename(playlist.owner)}/{detox_filename(playlist.title)}"
+        video_urls = (playlist_video for playlist_video in playlist.video_urls if not is_downloaded("youtube", playlist_video))
+
+        # videos are resolved a few entries ahead and handed on one at a time. the transfer queue is
+        # bounded so a long playlist only ever has a handful of YouTube objects alive
+        videos = prefetch(video_urls, resolve_playlist_video, Settings["youtube"]["playlist_prefetch"])
+    else:
+        videos = [resolve_youtube_video(task.Url)]
+
+    for video in videos:
+        if video is None:
+            continue
+        check_cancelled(task.JobId)
+        try:
+            video_task = PrepareYTVideo(GrabTask("youtube", video.watch_url, task.DestinationDir, task.JobId), video, playlist_path)
+        except Exception as e:
+            if playlist_path is None:
+                raise
+            if not retry_playlist_video(video.watch_url, e):
+                print(f"[Youtube] Failed grabbing {video.watch_url}: {type(e).__name__}: {e}")
+            continue
+        if video_task is not None:
+            video_task.Playlist = playlist_path is not None
+            yield video_task
+
+def PrepareYTVideo(task, video, playlist_path):
+    try:
+        if video.age_restricted:
+            video.bypass_age_gate()
+        video_streams = [stream for stream in video.streams.filter(file_extension='mp4', type='video') if stream.includes_video_track]
+        audio_stream = None
+        if any(not stream.includes_audio_track for stream in video_streams):
+            for stream in video.streams.filter(file_extension='mp4', type='audio').order_by('bitrate').desc():
+                if stream.includes_audio_track:
+                    audio_stream = stream
+                    break
+
+    except exceptions.AgeRestrictedError as e:
+        count_failure("youtube", e)
+        print(f'Video {video.title} is age restricted, skipping.')
+        return None
+    except exceptions.MembersOnly as e:
+        count_failure("youtube", e)
+        print(f'Video {video.title} is for members only, skipping.')
+        return None
+    except exceptions.VideoPrivate as e:
+        count_failure("youtube", e)
+        print(f'Video {video.title} is private, skipping.')
+        return None
+    except exceptions.VideoRegionBlocked as e:
+        count_failure("youtube", e)
+        print(f'Video {video.title} is region blocked, skipping.')
+        return None
+    except exceptions.LiveStreamError as e:
+        count_failure("youtube", e)
+        print(f'Video {video.title} is a live stream, skipping.')
+        return None
+    except exceptions.VideoUnavailable as e:
+        count_failure("youtube", e)
+        print(f'Video {video.title} is unavaialable, skipping.')
+        return None
+
+    if len(video_streams) == 0:
+        print(f'Video {video.title} doesnt have a valid video stream, skipping.')
+        return None
+
+    # video only streams get the audio added to their size, it ends up in the same file
+    audio_size = audio_stream.filesize_approx if audio_stream is not None else 0
+    options = [Option(stream.resolution, parse_height(stream.resolution), stream.filesize_approx + (0 if stream.includes_audio_track else audio_size), stream) for stream in video_streams]
+    option, task.Reservation = quality_policy.choose("youtube", task.DestinationDir, options)
+    if option is None:
+        print(f'Video {video.title} has no stream under the configured limits, skipping.')
+        return None
+    video_stream = option.Source
+    if video_stream.includes_audio_track:
+        audio_stream = None
+
+    if not video_stream.includes_audio_track and audio_stream is None:
+        print(f'Video {video.title} doesnt have a valid audio stream. Continuing without audio.')
         
-        videos = []
-        playlist_path = None
-        use_oauth = False
-        oauth_cache = False
-        if "list" in url:
-            playlist = Playlist(url)
-            print(f"[Youtube] Found Playlist: {playlist.title}")
-            playlist_path = f"{detox_filename(playlist.owner)}/{detox_filename(playlist.title)}"
-            for playlist_video in playlist.video_urls:
-                videos.append(YouTube(playlist_video + "&has_verified=1", use_oauth=use_oauth, allow_oauth_cache=oauth_cache))
+
+    task.Source = video
+    task.Name = video.title
+    task.VideoId = video.video_id
+    task.SubFolder = playlist_path if playlist_path is not None else f"{detox_filename(video.author)}"
+    task.FinalName = f"{detox_filename(video.title)}.{video_stream.subtype}"
+    task.Parts = (video_stream, audio_stream)
+    return task
+
+def TransferYT(task):
+    video = task.Source
+    video_stream, audio_stream = task.Parts
+    final_name = task.FinalName
+
+    # grab the files into a staging folder keyed by the video id so a restart resumes the parts
+    temp_dir = os.path.join(get_staging_dir("youtube", task.DestinationDir), f"youtube_{video.video_id}")
+    os.makedirs(temp_dir, exist_ok=True)
+    task.TempDir = temp_dir
+    task.Reservation.track(temp_dir)
+    downloader = get_range_downloader("youtube", task.JobId)
+    set_job_state(task.JobId, DOWNLOADING)
+
+    # optionally pipe the video and audio straight into ffmpeg while they download
+    if Settings["youtube"]["streaming_mux"] and audio_stream is not None:
+        output_file = stream_youtube_video(video, video_stream, audio_stream, temp_dir, final_name, task.JobId)
+        if output_file is not None:
+            task.File = output_file
+            task.Parts = None
+            return [task]
+        print(f"[Youtube] Streaming mux failed for {video.title}. Downloading the parts instead.")
+
+    saved_video = os.path.join(temp_dir, "temp_v_" + final_name)
+    saved_audio = None
+    if audio_stream is not None:
+        saved_audio = os.path.join(temp_dir, "temp_a_" + f"{detox_filename(video.title)}.{audio_stream.subtype}")
+
+    # the video, the audio and every subtitle track are separate requests so fetch them all at once
+    print(f"[Youtube] Grabbing Video: {video.title}")
+    with phase_seconds.time(phase="download", site="youtube"), ThreadPoolExecutor(max_workers=Settings["youtube"]["parallel_parts"]) as pool:
+        video_future = pool.submit(downloader.download, video_stream.url, saved_video)
+        audio_future = None
+        if audio_stream is not None:
+            print(f"[Youtube] Grabbing Audio: {video.title}")
+            audio_future = pool.submit(downloader.download, audio_stream.url, saved_audio)
+        subtitle_futures = [pool.submit(fetch_subtitle, track, final_name, temp_dir) for track in video.captions]
+
+    # the downloader already retried, whatever is left fails the video so it can be queued again
+    video_future.result()
+
+    if audio_future is not None:
+        try:
+            audio_future.result()
+        except Exception as e:
+            if should_retry(e):
+                raise
+            print(f'Audio for {video.title} was unable to download: {type(e).__name__}: {e}')
+            saved_audio = None
+
+    subtitles = [subtitle for subtitle in (future.result() for future in subtitle_futures) if subtitle is not None]
+    task.File = saved_video
+    task.Parts = (saved_video, saved_audio, subtitles)
+    return [task]
+
+def PostprocessYT(task):
+    # a single ffmpeg pass joins the audio and bakes every subtitle, so each output byte is written once
+    if task.Parts is not None:
+        saved_video, saved_audio, subtitles = task.Parts
+        if saved_audio is not None or len(subtitles) > 0:
+            task.File = os.path.join(task.TempDir, task.FinalName)
+            set_job_state(task.JobId, MUXING)
+            print(f"[Youtube] Muxing {task.Name} with {'audio and ' if saved_audio is not None else ''}{len(subtitles)} subtitle tracks")
+            with phase_seconds.time(phase="mux", site="youtube"):
+                muxed = mux_video(saved_video, saved_audio, subtitles, task.File)
+            if not muxed:
+                print(f'Video {task.Name} failed to mux, keeping the parts in {task.TempDir}.')
+                return None
+    return FinishGrab(task)
+
+# output paths are cached and only reloaded when the config file changes
+output_paths_cache = None
+output_paths_mtime = None
+output_paths_missing = False
+
+def load_output_paths():
+    global output_paths_cache, output_paths_mtime, output_paths_missing
+    try:
+        mtime = os.path.getmtime(output_path_config)
+        output_paths_missing = False
+        if mtime != output_paths_mtime:
+            # a file caught half saved or badly edited is only reported once, the last good paths stay in use
+            output_paths_mtime = mtime
+            with open(output_path_config, 'r') as json_file:
+                output_paths_cache = json.load(json_file)
+    except FileNotFoundError:
+        if not output_paths_missing:
+            print(f"[vrp]{output_path_config} not found.")
+            output_paths_missing = True
+    except (OSError, ValueError) as e:
+        print(f"[Daemon] Unable to load {output_path_config}: {type(e).__name__}: {e}. Keeping the previous output paths.")
+    return output_paths_cache
+
+def classify_urls(lines):
+    ph_urls = []
+    yt_urls = []
+    vrp_urls = []
+    invalid_urls = []
+
+    for line in lines:
+        line = line.strip()
+        site = classify_url(line)
+        if site == "pornhub":
+            ph_urls.append(line)
+        elif site == "vrporn":
+            vrp_urls.append(line)
+        elif site == "youtube":
+            yt_urls.append(line)
         else:
-            videos.append(YouTube(url + "&has_verified=1", use_oauth=use_oauth, allow_oauth_cache=oauth_cache))
-
-        for video in videos:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                video_stream = None
-                try:
-                    if video.age_restricted:
-                        video.bypass_age_gate()
-                    video_stream = None
-                    audio_stream = None
-                    for stream in video.streams.filter(file_extension='mp4', type='video').order_by('resolution').desc():
-                        if stream.includes_video_track:
-                            video_stream = stream
-                            break
-                    
-                    if video_stream and not video_stream.includes_audio_track:
-                        for stream in video.streams.filter(file_extension='mp4', type='audio').order_by('bitrate').desc():
-                            if stream.includes_audio_track:
-                                audio_stream = stream
-                                break
-
-                except exceptions.AgeRestrictedError:
-                    print(f'Video {video.title} is age restricted, skipping.')
-                    continue
-                except exceptions.MembersOnly:
-                    print(f'Video {video.title} is for members only, skipping.')
-                    continue
-                except exceptions.VideoPrivate:
-                    print(f'Video {video.title} is private, skipping.')
-                    continue
-                except exceptions.VideoRegionBlocked:
-                    print(f'Video {video.title} is region blocked, skipping.')
-                    continue
-                except exceptions.LiveStreamError:
-                    print(f'Video {video.title} is a live stream, skipping.')
-                    continue
-                except exceptions.VideoUnavailable:
-                    print(f'Video {video.title} is unavaialable, skipping.')
-                    continue
+            invalid_urls.append(line)
 
-                if video_stream is None:
-                    print(f'Video {video.title} doesnt have a valid video stream, skipping.')
-                    continue
+    return ph_urls, vrp_urls, yt_urls, invalid_urls
 
-                if not video_stream.includes_audio_track and audio_stream is None:
-                    print(f'Video {video.title} doesnt have a valid audio stream. Continuing without audio.')
-                    
-
-                subfolder = playlist_path if playlist_path is not None else f"{detox_filename(video.author)}"
-                final_name = f"{detox_filename(video.title)}.{video_stream.subtype}"
-                
-                # grab the files into our temp path
-                print(f"[Youtube] Grabbing Video: {video.title}")
-                video_stream.on_progress = partial(on_video_download, video_stream)
-
-                saved_video = None
-                try:
-                    saved_video = video_stream.download(temp_dir, "temp_v_" + final_name)
-                except:
-                    print(f'Video {video.title} is unable to download, skipping.')
-                    continue
+# every video goes resolve -> transfer -> postprocess, each stage with its own workers, so
+# one video can be muxing or moving while the next downloads and the one after is scraped
+SiteStages = {
+    "pornhub": (ResolvePH, TransferPH, FinishGrab),
+    "vrporn": (ResolveVRP, TransferVRP, FinishGrab),
+    "youtube": (ResolveYT, TransferYT, PostprocessYT),
+}
 
-                saved_audio = None
-                if audio_stream is not None:
-                    print(f"[Youtube] Grabbing Audio: {video.title}")
-                    audio_stream.on_progress = partial(on_audio_download, audio_stream)
-                    try:
-                        saved_audio = audio_stream.download(temp_dir, "temp_a_" + f"{detox_filename(video.title)}.{audio_stream.subtype}")
-                    except:
-                        print(f'Audio for {video.title} was unable to download.')
-                        saved_audio = None
-
-                if saved_audio is not None:
-                    combined_file = os.path.join(temp_dir, "temp_c_" + f"{detox_filename(video.title)}.{video_stream.subtype}")
-                    ffmpeg_command = [
-                        'ffmpeg',
-                        '-y',
-                        '-i', saved_video,        # Input video file
-                        '-i', saved_audio,        # Input audio file
-                        '-c', 'copy',            # Copy codec (no re-encoding)
-                        '-map', '0:v',           # Map video stream from first input
-                        '-map', '1:a',           # Map audio stream from second input
-                        combined_file
-                    ]
-
-                    # Execute the ffmpeg command
-                    print(f"[Youtube] Joining Video and Audio: {video.title}")
-                    subprocess.run(ffmpeg_command)
-                    os.remove(saved_video)
-                    os.remove(saved_audio)
-                    saved_video = combined_file
-                    
-
-                # grab the subtitles if any
-                subtitle_tracks = video.captions
-                ffmpeg_subtitle_inputs = []
-                ffmpeg_subtitle_maps = []
-                ffmpeg_subtitle_metadata = []
-                index = 0
-                for track in subtitle_tracks:
-                    if track.xml_captions == '':
-                        print(f"[Youtube] Failed downloading subtitle track: {track.name}")
-                        continue
-                    print(f"[Youtube] Downloading subtitle track: {track.name}")
-                    
-                    language_code = track.code
-                    if language_code.startswith("a."):
-                        language_code = language_code[2:]
-
-                    srt_subtitles = xml_caption_to_srt(track, track.xml_captions)
-                    srt_subtitles_file_name = f"{final_name}_subtitle_{track.code}.srt"
-                    
-                    srt_subtitles_file = os.path.join(temp_dir, srt_subtitles_file_name)
-                    with open(os.path.join(srt_subtitles_file), 'w', encoding='utf-8') as file:
-                        file.write(srt_subtitles)
-
-                    print(f"[Youtube] Subtitle track '{track.name}' downloaded and converted to {srt_subtitles_file}")
-
-                    ffmpeg_subtitle_inputs.append("-i")
-                    ffmpeg_subtitle_inputs.append(srt_subtitles_file)
-                    ffmpeg_subtitle_maps.append("-map")
-                    ffmpeg_subtitle_maps.append(f"{index + 1}") # because map 0 will be the input file later
-                    ffmpeg_subtitle_metadata.append(f"-metadata:s:s:{index}")
-                    ffmpeg_subtitle_metadata.append(f"language={language_code}")
-                    ffmpeg_subtitle_metadata.append(f"-metadata:s:s:{index}")
-                    ffmpeg_subtitle_metadata.append(f"title={track.name}")
-
-                    index += 1
-
-
-                if index > 0:
-                    # Combine video and subtitles using ffmpeg
-                    output_file = os.path.join(temp_dir, final_name)
-
-                    ffmpeg_cmd = [
-                        "ffmpeg",
-                        '-y',
-                        "-i", saved_video] + ffmpeg_subtitle_inputs + [
-                        "-map", "0"] +  ffmpeg_subtitle_maps + [
-                        "-c:v", "copy",
-                        "-c:a", "copy",
-                        "-c:s", "mov_text"] + ffmpeg_subtitle_metadata + [
-                        output_file
-                    ]
-
-                    print(f"[Youtube] Baking the subtitles")
-                    subprocess.run(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                    os.remove(saved_video)
-                    move_video(VideoFileData(Filename=final_name, SubFolder=subfolder, File=output_file), destination_dir)
-                else:
-                    move_video(VideoFileData(Filename=final_name, SubFolder=subfolder, File=saved_video), destination_dir)
+def run_stage(index, task):
+    # the reserved space is given back once the video is in place or didnt make it
+    try:
+        results = SiteStages[task.Site][index](task)
+    except BaseException as e:
+        release_space(task)
+        if task.Playlist and isinstance(e, Exception) and retry_playlist_video(task.Url, e, task.Site):
+            return None
+        raise
+    if results is None or index == len(SiteStages[task.Site]) - 1:
+        release_space(task)
+    return results
 
-def main():
+# what each job is still waiting on, for the jobs_running gauge
+running = {site: 0 for site in Sites}
+running_lock = threading.Lock()
 
-    if not os.path.exists(GlobalArgs.filename):
-        print(f"File '{GlobalArgs.filename}' not found.")
+def update_running(site, change):
+    with running_lock:
+        running[site] += change
+        jobs_running.set(running[site], site=site)
+
+def finish_task(ticket):
+    task = ticket.Item
+    update_running(task.Site, -1)
+    with in_flight_lock:
+        in_flight.discard(in_flight_key(task))
+    for error in ticket.Errors:
+        if not isinstance(error, JobCancelled):
+            count_failure(task.Site, error)
+    if task.JobId is None:
+        # urls from a -i file have no job yet. one that can be retried gets one instead of being lost
+        if len(ticket.Results) == 0 and len(ticket.Errors) > 0 and should_retry(ticket.Errors[0]):
+            queue_retry(task.Url, ticket.Errors[0])
         return
-    
-    # load in output paths
-    output_path_config = f"{GlobalArgs.config_dir}/output_paths"
-    output_paths = {}
+
+    if any(isinstance(error, JobCancelled) for error in ticket.Errors):
+        # cancel() already marked it, this only makes sure a job stopped some other way ends up the same
+        jobs.cancel(task.JobId)
+        print(f"[Jobs] Job {task.JobId} was cancelled: {task.Url}")
+        return
+
     try:
-        with open(output_path_config, 'r') as json_file:
-            output_paths = json.load(json_file)
-    except FileNotFoundError:
-        print(f"[vrp]{output_path_config} not found.")
-        return []
-    
+        if len(ticket.Results) == 1:
+            jobs.set_state(task.JobId, DONE, path=ticket.Results[0])
+        elif len(ticket.Results) > 1:
+            # a playlist job points at the folder its videos went into
+            jobs.set_state(task.JobId, DONE, path=os.path.dirname(ticket.Results[0]))
+        elif len(ticket.Errors) > 0:
+            error = ticket.Errors[0]
+            print(f"[Jobs] Job {task.JobId} failed: {type(error).__name__}: {error}")
+            if should_retry(error):
+                queue_retry(task.Url, error, task.JobId)
+            else:
+                jobs.set_state(task.JobId, FAILED, error=f"{type(error).__name__}: {error}")
+        else:
+            jobs.set_state(task.JobId, FAILED, error="Nothing was downloaded, see the log")
+    except JobCancelled:
+        # cancelled after the last stage ran, the job store already says so
+        print(f"[Jobs] Job {task.JobId} was cancelled: {task.Url}")
+
+pipeline_settings = Settings["pipeline"]
+pipeline = Pipeline([
+    Stage("resolve", partial(run_stage, 0), pipeline_settings["resolve"], pipeline_settings["queue_size"]),
+    Stage("transfer", partial(run_stage, 1), Settings["concurrency"], pipeline_settings["queue_size"]),
+    Stage("postprocess", partial(run_stage, 2), pipeline_settings["postprocess"], pipeline_settings["queue_size"]),
+], key=lambda task: task.Site, on_done=finish_task)
+
+# one transfer per video at a time. two would write the same staging .part file
+in_flight = set()
+in_flight_lock = threading.Lock()
+
+def in_flight_key(task):
+    return task.Site, canonical_video_id(task.Site, task.Url) or task.Url
+
+def submit_task(task):
+    """Start task unless the same video is already running, which returns None instead."""
+    key = in_flight_key(task)
+    with in_flight_lock:
+        if key in in_flight:
+            return None
+        in_flight.add(key)
+    update_running(task.Site, 1)
+    return pipeline.submit(task)
+
+def process_file(filename):
+    if not os.path.exists(filename):
+        print(f"File '{filename}' not found.")
+        return
+
+    # load in output paths
+    output_paths = load_output_paths()
+    if output_paths is None:
+        return
+
     # get all the urls from the file
-    with open(GlobalArgs.filename, 'r') as file:
+    with open(filename, 'r') as file:
         lines = file.readlines()
 
-        ph_urls = []
-        yt_urls = []
-        vrp_urls = []
-        invalid_urls = []
-
-        for line in lines:
-            line = line.strip()
-            if validators.url(line):
-                if "pornhub" in line:
-                    ph_urls.append(line)
-                elif "vrporn" in line:
-                    vrp_urls.append(line)
-                elif "youtu" in line: # to get both youtube.com and youtu.be urls
-                    yt_urls.append(line)
-                else:
-                    invalid_urls.append(line)
-            else:
-                invalid_urls.append(line)
-            
-    # grab every video that is valid
-    GrabPH(ph_urls, output_paths["pornhub"])
-    GrabVRP(vrp_urls, output_paths["vrporn"])
-    GrabYT(yt_urls, output_paths["youtube"])
-        
+    with phase_seconds.time(phase="classify", site="all"):
+        ph_urls, vrp_urls, yt_urls, invalid_urls = classify_urls(lines)
+
+    # drop anything we already have before a single client or page object gets created
+    ph_urls = [url for url in ph_urls if not is_downloaded("pornhub", url)]
+    vrp_urls = [url for url in vrp_urls if not is_downloaded("vrporn", url)]
+    yt_urls = [url for url in yt_urls if not is_downloaded("youtube", url)]
+
+    # queue every video that is valid, once
+    for site, urls in [("pornhub", ph_urls), ("vrporn", vrp_urls), ("youtube", yt_urls)]:
+        for url in urls:
+            if submit_task(GrabTask(site, url, output_paths[site])) is None:
+                print(f"[Jobs] Skipping duplicate url: {url}")
+
+def watch_directory(watch_dir, on_change):
+    # let inotifywait block until a file is fully written instead of polling the folder
+    command = ['inotifywait', '-m', '-q', '-e', 'close_write', '-e', 'moved_to', '--format', '%f', watch_dir]
+    while True:
+        try:
+            watcher = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        except FileNotFoundError:
+            print("[Daemon] inotifywait not found, falling back to polling")
+            while True:
+                on_change()
+                time.sleep(5)
+
+        for _ in watcher.stdout:
+            on_change()
+        watcher.wait()
+
+        # start it again, and rescan for anything that arrived while it was down
+        print(f"[Daemon] inotifywait exited with {watcher.returncode}, restarting it")
+        time.sleep(5)
+        on_change()
+
+def queue_file(filename, done_dir):
+    # files dropped in the watch folder are just another way to submit jobs
+    if not os.path.isfile(filename):
+        return
+    with open(filename, 'r') as file:
+        lines = file.readlines()
+    with phase_seconds.time(phase="classify", site="all"):
+        ids, invalid_urls = jobs.add(lines)
+    print(f"[Jobs] Queued {len(ids)} urls from {filename}")
+    for url in invalid_urls:
+        print(f"[Jobs] Skipping invalid url: {url}")
+    shutil.move(filename, os.path.join(done_dir, os.path.basename(filename)))
+
+queue_lock = threading.Lock()
+def queue_folder(watch_dir, done_dir):
+    # every event rescans the whole folder, so nothing dropped in between two events or
+    # before the watcher was up is missed. queued files move out, so none is added twice
+    with queue_lock:
+        for entry in sorted(os.listdir(watch_dir)):
+            queue_file(os.path.join(watch_dir, entry), done_dir)
+
+def finish_claimed(site, url, job_id):
+    # a claimed job for a video that is already in the ledger
+    try:
+        jobs.set_state(job_id, DONE, path=(ledger.get(site, canonical_video_id(site, url)) or {}).get('path'))
+    except JobCancelled:
+        print(f"[Jobs] Job {job_id} was cancelled: {url}")
+
+def run_daemon():
+    watch_dir = os.path.abspath(GlobalArgs.watch_dir)
+    done_dir = os.path.abspath(GlobalArgs.done_dir)
+    for folder in [watch_dir, done_dir]:
+        if not os.path.exists(folder):
+            print(f"Creating folder: {folder}")
+            os.makedirs(folder)
+
+    # anything that was running when we stopped picks up from its staged parts
+    requeued = jobs.requeue_interrupted()
+    if requeued > 0:
+        print(f"[Jobs] Re-queued {requeued} interrupted jobs")
+
+    # watch first and then pick up anything that was dropped in while we were not running,
+    # so a file arriving in between is caught by one or the other
+    on_change = partial(queue_folder, watch_dir, done_dir)
+    Thread(target=watch_directory, daemon=True, args=(watch_dir, on_change)).start()
+    on_change()
+    print(f"Add a file with a unique URL per line inside of: {watch_dir}")
+
+    # only claim as many jobs as fit in each site's resolve queue, so priorities still
+    # apply to everything that is waiting. any write to the job store wakes us up
+    watch = DirectoryWatch(os.path.abspath(GlobalArgs.config_dir))
+    missing_sites = set()
+    deferred = []
+    while True:
+        # jobs for a video that was already running wait here until it is done
+        waiting = deferred
+        deferred = []
+        for task in waiting:
+            if jobs.is_cancelled(task.JobId):
+                continue
+            if is_downloaded(task.Site, task.Url):
+                finish_claimed(task.Site, task.Url, task.JobId)
+            elif submit_task(task) is None:
+                deferred.append(task)
+
+        output_paths = load_output_paths()
+        if output_paths is not None:
+            for site in Sites:
+                # jobs for a site without an output path wait in the queue until one is configured
+                if site not in output_paths:
+                    if site not in missing_sites:
+                        print(f"[Daemon] No output path for {site} in {output_path_config}. Leaving its jobs queued.")
+                        missing_sites.add(site)
+                    continue
+                missing_sites.discard(site)
+
+                for job in jobs.claim(site, pipeline.capacity(site)):
+                    url = job['url']
+                    if is_downloaded(site, url):
+                        finish_claimed(site, url, job['id'])
+                        continue
+                    task = GrabTask(site, url, output_paths[site], job['id'])
+                    if submit_task(task) is None:
+                        print(f"[Jobs] Job {job['id']} waits for the running download of the same video: {url}")
+                        deferred.append(task)
+        watch.wait(1.0)
+
+def main():
+    if GlobalArgs.daemon:
+        run_daemon()
+    else:
+        process_file(GlobalArgs.filename)
+        pipeline.wait()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,214 @@
+import validators
+import threading
+import sqlite3
+import time
+
+from retry import backoff
+
+QUEUED = "queued"
+RETRYING = "retrying"
+RESOLVING = "resolving"
+DOWNLOADING = "downloading"
+MUXING = "muxing"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+ActiveStates = [RESOLVING, DOWNLOADING, MUXING]
+FinalStates = [DONE, FAILED, CANCELLED]
+
+JobColumns = ['id', 'url', 'site', 'priority', 'state', 'error', 'path', 'created_at', 'updated_at', 'attempts', 'retry_at']
+
+class JobCancelled(Exception):
+    pass
+
+def classify_url(url):
+    """Site a url belongs to, or None if we cant download it."""
+    url = url.strip()
+    if not validators.url(url):
+        return None
+    if "pornhub" in url:
+        return "pornhub"
+    if "vrporn" in url:
+        return "vrporn"
+    if "youtu" in url: # to get both youtube.com and youtu.be urls
+        return "youtube"
+    return None
+
+class JobStore:
+    """Durable download queue shared by server.py and the downloader.
+
+    Backed by sqlite in WAL mode so the web server can add and list jobs while
+    the downloader claims and updates them from another process. Jobs are
+    claimed per site in priority order, highest first, then oldest first.
+    Jobs that failed with a retriable error wait in the retrying state until
+    their retry_at and are then claimed like queued ones.
+    """
+    def __init__(self, filename):
+        self.Filename = filename
+        self.lock = threading.Lock()
+        self.Connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        with self.lock, self.Connection:
+            self.Connection.execute("PRAGMA journal_mode=WAL")
+            self.Connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT NOT NULL,
+                    site TEXT NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    state TEXT NOT NULL,
+                    error TEXT,
+                    path TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    retry_at REAL
+                )
+            """)
+            # stores made before retries existed
+            columns = [row[1] for row in self.Connection.execute("PRAGMA table_info(jobs)")]
+            if 'attempts' not in columns:
+                self.Connection.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            if 'retry_at' not in columns:
+                self.Connection.execute("ALTER TABLE jobs ADD COLUMN retry_at REAL")
+            # claiming only ever looks at queued jobs of one site in priority order
+            self.Connection.execute("CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, site, priority DESC, id)")
+            self.Connection.execute("CREATE INDEX IF NOT EXISTS jobs_url ON jobs (url)")
+
+    def row_to_job(self, row):
+        return dict(zip(JobColumns, row))
+
+    def add(self, urls, priority=0, state=QUEUED, retry_at=None, attempts=0, error=None):
+        """Queue every url in one transaction. Returns (job ids, urls that were rejected).
+
+        A url that already has a job which isnt finished gets that job's id instead
+        of a second job, so the same video never runs twice. A url that already
+        failed can go straight in as RETRYING with its retry_at, so it cant be
+        claimed before it is due.
+        """
+        now = time.time()
+        rows = []
+        invalid = []
+        for url in urls:
+            url = url.strip()
+            if url == "":
+                continue
+            site = classify_url(url)
+            if site is None:
+                invalid.append(url)
+                continue
+            rows.append((url, site, int(priority), state, retry_at, attempts, error, now, now))
+
+        with self.lock, self.Connection:
+            cursor = self.Connection.cursor()
+            ids = []
+            placeholders = ', '.join('?' for _ in FinalStates)
+            for row in rows:
+                existing = cursor.execute(f"SELECT id FROM jobs WHERE url = ? AND state NOT IN ({placeholders}) ORDER BY id LIMIT 1", (row[0], *FinalStates)).fetchone()
+                if existing is not None:
+                    ids.append(existing[0])
+                    continue
+                cursor.execute("INSERT INTO jobs (url, site, priority, state, retry_at, attempts, error, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+                ids.append(cursor.lastrowid)
+        return ids, invalid
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.Connection.execute(f"SELECT {', '.join(JobColumns)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self.row_to_job(row) if row is not None else None
+
+    def list(self, state=None, before=None, limit=100):
+        """Newest first. Page with before=<smallest id of the previous page>."""
+        query = f"SELECT {', '.join(JobColumns)} FROM jobs"
+        conditions = []
+        params = []
+        if state is not None:
+            conditions.append("state = ?")
+            params.append(state)
+        if before is not None:
+            conditions.append("id < ?")
+            params.append(int(before))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(int(limit))
+        with self.lock:
+            rows = self.Connection.execute(query, params).fetchall()
+        return [self.row_to_job(row) for row in rows]
+
+    def counts(self):
+        with self.lock:
+            rows = self.Connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
+
+    def claim(self, site, count):
+        """Move up to count queued jobs, or retrying jobs that are due, of a site to resolving and return them."""
+        if count <= 0:
+            return []
+        now = time.time()
+        claimed = []
+        with self.lock, self.Connection:
+            rows = self.Connection.execute(
+                f"SELECT {', '.join(JobColumns)} FROM jobs WHERE state IN (?, ?) AND site = ? AND (retry_at IS NULL OR retry_at <= ?) ORDER BY priority DESC, id LIMIT ?",
+                (QUEUED, RETRYING, site, now, count)).fetchall()
+            for row in rows:
+                job = self.row_to_job(row)
+                # the server may have cancelled it since the select
+                cursor = self.Connection.execute("UPDATE jobs SET state = ?, retry_at = NULL, updated_at = ? WHERE id = ? AND state = ?", (RESOLVING, now, job['id'], job['state']))
+                if cursor.rowcount == 1:
+                    job['state'] = RESOLVING
+                    claimed.append(job)
+        return claimed
+
+    def set_state(self, job_id, state, error=None, path=None):
+        """Move a job along. Raises JobCancelled if it was cancelled in the meantime."""
+        with self.lock, self.Connection:
+            cursor = self.Connection.execute(
+                "UPDATE jobs SET state = ?, error = ?, path = COALESCE(?, path), updated_at = ? WHERE id = ? AND state != ?",
+                (state, error, path, time.time(), job_id, CANCELLED))
+        if cursor.rowcount == 0:
+            raise JobCancelled(f"Job {job_id} was cancelled")
+
+    def retry(self, job_id, error, base_delay, max_delay, max_attempts):
+        """Send a job that failed with a retriable error back to wait for a later attempt.
+
+        Each attempt waits twice as long as the last. Once max_attempts is used up
+        the job fails for good. Returns the new state, raises JobCancelled like set_state.
+        """
+        with self.lock, self.Connection:
+            row = self.Connection.execute("SELECT attempts, state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row[1] == CANCELLED:
+                raise JobCancelled(f"Job {job_id} was cancelled")
+            attempts = row[0] + 1
+            now = time.time()
+            if attempts >= max_attempts:
+                state, retry_at = FAILED, None
+            else:
+                state, retry_at = RETRYING, now + backoff(attempts - 1, base_delay, max_delay)
+            self.Connection.execute(
+                "UPDATE jobs SET state = ?, error = ?, attempts = ?, retry_at = ?, updated_at = ? WHERE id = ? AND state != ?",
+                (state, error, attempts, retry_at, now, job_id, CANCELLED))
+        return state
+
+    def cancel(self, job_id):
+        """Cancel a job that hasnt finished. Running jobs stop at their next state change."""
+        with self.lock, self.Connection:
+            placeholders = ', '.join('?' for _ in FinalStates)
+            cursor = self.Connection.execute(
+                f"UPDATE jobs SET state = ?, updated_at = ? WHERE id = ? AND state NOT IN ({placeholders})",
+                (CANCELLED, time.time(), job_id, *FinalStates))
+        return cursor.rowcount == 1
+
+    def is_cancelled(self, job_id):
+        with self.lock:
+            row = self.Connection.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is not None and row[0] == CANCELLED
+
+    def requeue_interrupted(self):
+        """Put jobs that were running when the downloader stopped back in the queue so they resume."""
+        placeholders = ', '.join('?' for _ in ActiveStates)
+        with self.lock, self.Connection:
+            cursor = self.Connection.execute(
+                f"UPDATE jobs SET state = ?, updated_at = ? WHERE state IN ({placeholders})",
+                (QUEUED, time.time(), *ActiveStates))
+        return cursor.rowcount
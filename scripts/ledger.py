@@ -0,0 +1,86 @@
+import threading
+import sqlite3
+import time
+import os
+
+from urllib.parse import urlparse
+from urllib.parse import parse_qs
+
+def canonical_video_id(site, url):
+    """Stable id for a video url, or None when the url does not point at a single video."""
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    path = parsed.path.strip('/')
+
+    if site == "pornhub":
+        # https://www.pornhub.com/view_video.php?viewkey=ph123
+        if 'viewkey' in query:
+            return query['viewkey'][0]
+        return path.lower() if path else None
+
+    if site == "vrporn":
+        # https://vrporn.com/some-video-slug/
+        return path.lower() if path else None
+
+    if site == "youtube":
+        # playlists are checked video by video once they are expanded
+        if 'list' in query:
+            return None
+
+        # watch?v=, youtu.be/<id>, /shorts/<id>, /embed/<id>, /live/<id>
+        if 'v' in query:
+            return query['v'][0]
+        parts = path.split('/')
+        if parsed.hostname is not None and parsed.hostname.endswith("youtu.be") and parts[0]:
+            return parts[0]
+        if len(parts) == 2 and parts[0] in ["shorts", "embed", "live"]:
+            return parts[1]
+        return None
+
+    return None
+
+class DownloadLedger:
+    """Record of every finished download keyed by site and canonical video id.
+
+    Backed by sqlite with the key as the primary key, so a lookup stays an
+    index seek no matter how many videos have been downloaded.
+    """
+    def __init__(self, filename):
+        self.Filename = filename
+        self.lock = threading.Lock()
+        self.Connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.Connection:
+            self.Connection.execute("PRAGMA journal_mode=WAL")
+            self.Connection.execute("""
+                CREATE TABLE IF NOT EXISTS downloads (
+                    site TEXT NOT NULL,
+                    video_id TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER,
+                    completed_at REAL NOT NULL,
+                    PRIMARY KEY (site, video_id)
+                ) WITHOUT ROWID
+            """)
+
+    def contains(self, site, video_id):
+        if video_id is None:
+            return False
+        with self.lock:
+            row = self.Connection.execute("SELECT 1 FROM downloads WHERE site = ? AND video_id = ?", (site, video_id)).fetchone()
+        return row is not None
+
+    def get(self, site, video_id):
+        with self.lock:
+            row = self.Connection.execute("SELECT path, size, completed_at FROM downloads WHERE site = ? AND video_id = ?", (site, video_id)).fetchone()
+        if row is None:
+            return None
+        return {'path': row[0], 'size': row[1], 'completed_at': row[2]}
+
+    def record(self, site, video_id, path):
+        if video_id is None or path is None:
+            return
+        size = os.path.getsize(path) if os.path.exists(path) else None
+        with self.lock, self.Connection:
+            self.Connection.execute(
+                "INSERT OR REPLACE INTO downloads (site, video_id, path, size, completed_at) VALUES (?, ?, ?, ?, ?)",
+                (site, video_id, path, size, time.time()))
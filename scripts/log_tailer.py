@@ -0,0 +1,224 @@
+import threading
+import ctypes
+import ctypes.util
+import select
+import itertools
+import time
+import os
+
+from collections import deque
+
+# inotify flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+class DirectoryWatch:
+    """Blocks until something changes in a directory, using inotify through libc.
+
+    Falls back to a plain sleep when inotify is not available, which turns the
+    tailer into a slow poll instead of failing.
+    """
+    def __init__(self, directory):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+            if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.fd = fd
+        except (OSError, AttributeError) as e:
+            print(f"[Tailer] inotify unavailable ({e}), polling instead")
+
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            # we only care that something happened, drain the events
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class RestartableThread:
+    """Runs self.run() on a daemon thread that can be started and stopped any number of times.
+
+    run() should return soon after stop_event is set. on_start() runs under the
+    lock just before each new thread, while nothing else is reading.
+    """
+    def __init__(self):
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                if not self.stop_event.is_set():
+                    return
+                # a previous stop is still winding down
+                self.thread.join()
+
+            self.on_start()
+
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def on_start(self):
+        pass
+
+    def stop(self, wait=False):
+        self.stop_event.set()
+        thread = self.thread
+        if wait and thread is not None:
+            thread.join()
+
+    def is_alive(self):
+        # a stopped thread may still be finishing its last pass
+        return self.thread is not None and self.thread.is_alive()
+
+    def is_running(self):
+        return self.is_alive() and not self.stop_event.is_set()
+
+class LogTailer(RestartableThread):
+    """Follows a log file and hands new lines to on_lines in batches.
+
+    Sleeps until the file changes, reads only what was appended and emits at
+    most once per interval. Handles the file being truncated or replaced.
+    Can be started and stopped any number of times, and picks up where it left
+    off when restarted.
+
+    The last history lines are kept in memory, each tagged with a running line
+    number, so clients can be sent recent history without touching the file.
+    """
+    def __init__(self, filename, on_lines, interval=0.5, history=1000):
+        super().__init__()
+        self.Filename = os.path.abspath(filename)
+        self.OnLines = on_lines
+        self.Interval = interval
+        self.History = deque(maxlen=history)
+        self.NextLine = 0
+        self.history_lock = threading.Lock()
+
+        # where we are in the file, kept across restarts
+        self.log_file = None
+        self.inode = None
+        self.partial = ''
+        self.reported_missing = False
+
+    def on_start(self):
+        # nobody was listening while we were stopped, so anything written since
+        # only goes into the history instead of being broadcast
+        self.poll(broadcast=False)
+
+    def refresh(self):
+        # catch up with the file when the thread isnt, e.g. a /log request without any socket client
+        with self.lock:
+            if not self.is_alive():
+                self.poll(broadcast=False)
+
+    def recent(self, count):
+        """The last count lines as (first line number, lines)."""
+        with self.history_lock:
+            lines = list(self.History)[-count:] if count > 0 else []
+            return self.NextLine - len(lines), lines
+
+    def page(self, offset, limit):
+        """Up to limit lines starting at line number offset, clamped to what is still in memory."""
+        with self.history_lock:
+            oldest = self.NextLine - len(self.History)
+            offset = min(max(offset, oldest), self.NextLine)
+            first = offset - oldest
+            return offset, list(itertools.islice(self.History, first, first + max(0, limit)))
+
+    def run(self):
+        print(f"Monitoring Log: {self.Filename}")
+        watch = DirectoryWatch(os.path.dirname(self.Filename))
+        try:
+            while not self.stop_event.is_set():
+                self.poll(broadcast=True)
+
+                # sleep until the file changes, then give writers a moment so lines batch up
+                watch.wait(1.0)
+                self.stop_event.wait(self.Interval)
+        finally:
+            watch.close()
+            print("closing read_log thread")
+
+    def poll(self, broadcast):
+        try:
+            stat = os.stat(self.Filename)
+        except FileNotFoundError:
+            if not self.reported_missing:
+                message = f"Log File {self.Filename} not found."
+                print(message)
+                self.add_lines([message], broadcast)
+                self.reported_missing = True
+            return
+
+        self.reported_missing = False
+        if self.log_file is not None and stat.st_ino != self.inode:
+            # rotated: finish the old file, then follow the new one from the top
+            self.read_new(broadcast)
+            self.log_file.close()
+            self.log_file = None
+
+        if self.log_file is None:
+            self.open_log(stat)
+        elif stat.st_size < self.log_file.tell():
+            # truncated in place
+            self.log_file.seek(0)
+            self.partial = ''
+
+        self.read_new(broadcast)
+
+    def open_log(self, stat):
+        first_open = self.inode is None
+        self.log_file = open(self.Filename, 'r', errors='replace')
+        self.inode = stat.st_ino
+        self.partial = ''
+
+        if first_open and self.History.maxlen > 0:
+            # start from the tail instead of reading a possibly huge log from the top,
+            # roughly 256 bytes a line is plenty to fill the history
+            start = max(0, stat.st_size - self.History.maxlen * 256)
+            self.log_file.seek(start)
+            if start > 0:
+                # we most likely landed mid line
+                self.log_file.readline()
+
+    def read_new(self, broadcast):
+        data = self.partial + self.log_file.read()
+        if data == '':
+            return
+        lines = data.split('\n')
+
+        # the last piece has no newline yet, keep it until the rest of the line shows up
+        self.partial = lines.pop()
+        new_lines = [line.strip() for line in lines if line.strip()]
+        if new_lines:
+            self.add_lines(new_lines, broadcast)
+
+    def add_lines(self, new_lines, broadcast):
+        with self.history_lock:
+            first = self.NextLine
+            self.History.extend(new_lines)
+            self.NextLine += len(new_lines)
+        if broadcast:
+            self.OnLines(first, new_lines)
@@ -0,0 +1,185 @@
+import threading
+import time
+
+from atomic import atomic_write
+from contextlib import contextmanager
+
+# seconds. phases range from a url classification to a multi hour download
+DefaultBuckets = [0.005, 0.05, 0.25, 1, 5, 15, 60, 300, 900, 3600, 4 * 3600]
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Metric:
+    Type = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.Name = name
+        self.Help = help
+        self.Labels = tuple(labels)
+        self.Values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.Labels)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.Labels, key)) + list(extra)
+        if len(pairs) == 0:
+            return ""
+        return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+    def samples(self):
+        with self.lock:
+            return [(self.Name, self.format_labels(key), value) for key, value in sorted(self.Values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.Name} {self.Help}", f"# TYPE {self.Name} {self.Type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    Type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.Values[key] = self.Values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.Values.get(self.key(labels), 0)
+
+class Gauge(Metric):
+    Type = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.Values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.Values[key] = self.Values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Throughput(Gauge):
+    """Per second rate of a counter, measured between two renders."""
+    def __init__(self, name, help, counter):
+        super().__init__(name, help, counter.Labels)
+        self.Counter = counter
+        self.last_values = {}
+        self.last_time = None
+
+    def samples(self):
+        now = time.monotonic()
+        with self.Counter.lock:
+            current = dict(self.Counter.Values)
+        with self.lock:
+            elapsed = now - self.last_time if self.last_time is not None else 0
+            for key, value in current.items():
+                # a site that showed up since the last render started from zero
+                previous = self.last_values.get(key, 0 if self.last_time is not None else value)
+                self.Values[key] = (value - previous) / elapsed if elapsed > 0 else 0
+            self.last_values = current
+            self.last_time = now
+        return super().samples()
+
+class Histogram(Metric):
+    Type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DefaultBuckets):
+        super().__init__(name, help, labels)
+        self.Buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.Values.get(key, ([0] * len(self.Buckets), 0.0, 0))
+            for index, bound in enumerate(self.Buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.Values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        # failed phases are timed too, a timeout is exactly where time goes
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.Values.items()):
+                for bound, bucket_count in zip(self.Buckets, counts):
+                    samples.append((f"{self.Name}_bucket", self.format_labels(key, [("le", format_value(bound))]), bucket_count))
+                samples.append((f"{self.Name}_bucket", self.format_labels(key, [("le", "+Inf")]), count))
+                samples.append((f"{self.Name}_sum", self.format_labels(key), total))
+                samples.append((f"{self.Name}_count", self.format_labels(key), count))
+        return samples
+
+class MetricsRegistry:
+    """Named metrics rendered in the Prometheus text format.
+
+    Recording is a dict update under a lock. With a snapshot file the rendered
+    text is written there every interval seconds, which is how the downloader
+    hands its numbers to server.py.
+    """
+    def __init__(self):
+        self.Metrics = []
+        self.lock = threading.Lock()
+        self.writer = None
+
+    def register(self, metric):
+        with self.lock:
+            self.Metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DefaultBuckets):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def throughput(self, name, help, counter):
+        return self.register(Throughput(name, help, counter))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.Metrics)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def start_writer(self, filename, interval=5.0):
+        if self.writer is not None:
+            return
+        self.writer = threading.Thread(target=self.write_snapshots, args=(filename, interval), daemon=True)
+        self.writer.start()
+
+    def write_snapshots(self, filename, interval):
+        while True:
+            try:
+                # the server never serves half a file
+                with atomic_write(filename) as metrics_file:
+                    metrics_file.write(self.render())
+            except OSError as e:
+                print(f"[Metrics] Unable to write {filename}: {e}")
+            time.sleep(interval)
@@ -6,6 +6,8 @@ command -v inotifywait >/dev/null 2>&1 || { echo >&2 "Please install inotify-too
 folder_to_monitor=$(readlink -f "$(pwd)/../input")
 folder_config=$(readlink -f "$(pwd)/../config")
 folder_done=$(readlink -f "$(pwd)/../done")
+progress_file=$(readlink -f "$(pwd)/../logs")/progress.json
+metrics_file=$(readlink -f "$(pwd)/../logs")/metrics.prom
 
 # Create the folder if it doesn't exist
 if [ ! -d "$folder_to_monitor" ]; then
@@ -17,17 +19,5 @@ if [ ! -d "$folder_done" ]; then
     mkdir -p "$folder_done"
 fi
 
-echo "Add a file with a unique URL per line inside of: $folder_to_monitor"
-
-inotifywait -m -e create "$folder_to_monitor" |
-    while read path action file; do
-        echo "Processing $file"
-        for existing_file in "$folder_to_monitor"/*; do
-            if [[ -f "$existing_file" ]]; then
-
-                python3 ./download.py -i "$existing_file" -c "$folder_config"
-                echo "$existing_file has finished processing"
-                mv "$existing_file" "$folder_done"
-            fi
-        done
-    done
+# a single resident downloader watches the folder itself and keeps its clients warm between files
+exec python3 -u ./download.py --daemon -w "$folder_to_monitor" -d "$folder_done" -c "$folder_config" --progress-file "$progress_file" --metrics-file "$metrics_file"
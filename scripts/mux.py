@@ -0,0 +1,132 @@
+import subprocess
+import threading
+import os
+
+def build_mux_command(video_input, audio_input, subtitles, output_file):
+    """One ffmpeg call that copies video, optional audio and converts every subtitle track.
+
+    subtitles is a list of objects with File, Language and Name.
+    """
+    command = ['ffmpeg', '-y', '-i', video_input]
+    if audio_input is not None:
+        command += ['-i', audio_input]
+    for subtitle in subtitles:
+        command += ['-i', subtitle.File]
+
+    # take the video from the first input and the audio from the second, or from the
+    # video itself when it already carries a track
+    command += ['-map', '0:v']
+    if audio_input is not None:
+        command += ['-map', '1:a']
+    else:
+        command += ['-map', '0:a?']
+
+    first_subtitle = 2 if audio_input is not None else 1
+    for index in range(len(subtitles)):
+        command += ['-map', f"{first_subtitle + index}"]
+
+    # no re-encoding, only the subtitles need converting for mp4
+    command += ['-c:v', 'copy', '-c:a', 'copy']
+    if len(subtitles) > 0:
+        command += ['-c:s', 'mov_text']
+    for index, subtitle in enumerate(subtitles):
+        command += [f"-metadata:s:s:{index}", f"language={subtitle.Language}"]
+        command += [f"-metadata:s:s:{index}", f"title={subtitle.Name}"]
+
+    command.append(output_file)
+    return command
+
+def mux_video(video_input, audio_input, subtitles, output_file):
+    command = build_mux_command(video_input, audio_input, subtitles, output_file)
+    try:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    except FileNotFoundError:
+        print("[Mux] ffmpeg not found")
+        return False
+
+    if result.returncode != 0:
+        # the end of ffmpeg's output is where the actual error is
+        error_lines = result.stderr.strip().splitlines()[-5:]
+        print(f"[Mux] ffmpeg failed with exit code {result.returncode}:")
+        for line in error_lines:
+            print(f"[Mux]   {line}")
+        return False
+    return True
+
+def release_pipe(pipe):
+    # opening the read end lets a writer that is stuck in open() through, its next write then fails
+    try:
+        os.close(os.open(pipe, os.O_RDONLY | os.O_NONBLOCK))
+    except OSError:
+        pass
+
+def mux_streaming(video_writer, audio_writer, subtitles, output_file, work_dir, reraise=()):
+    """Mux while the video and audio are still downloading.
+
+    video_writer and audio_writer are called with a writable file object and
+    must write their whole stream into it. They are fed to ffmpeg through named
+    pipes, so no intermediate video or audio file is ever written.
+    Returns False when the mux failed. A writer error of one of the reraise
+    types, e.g. a cancellation, is raised instead, so the caller doesnt fall back.
+    """
+    video_pipe = os.path.join(work_dir, "video.pipe")
+    audio_pipe = os.path.join(work_dir, "audio.pipe")
+    for pipe in [video_pipe, audio_pipe]:
+        if os.path.exists(pipe):
+            os.remove(pipe)
+        os.mkfifo(pipe)
+
+    log_file = os.path.join(work_dir, "ffmpeg.log")
+    command = build_mux_command(video_pipe, audio_pipe, subtitles, output_file)
+    errors = []
+    try:
+        with open(log_file, 'w') as log:
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=log)
+
+        def feed(writer, pipe):
+            try:
+                with open(pipe, 'wb') as file:
+                    writer(file)
+            except Exception as e:
+                errors.append(e)
+                # a short input would otherwise be muxed into a truncated file
+                process.kill()
+
+        feeders = [threading.Thread(target=feed, args=(video_writer, video_pipe), daemon=True),
+                   threading.Thread(target=feed, args=(audio_writer, audio_pipe), daemon=True)]
+        for feeder in feeders:
+            feeder.start()
+
+        returncode = process.wait()
+
+        # if ffmpeg went away before opening a pipe its writer would wait forever
+        for feeder, pipe in zip(feeders, [video_pipe, audio_pipe]):
+            while feeder.is_alive():
+                release_pipe(pipe)
+                feeder.join(timeout=0.5)
+    except FileNotFoundError:
+        print("[Mux] ffmpeg not found")
+        return False
+    finally:
+        for pipe in [video_pipe, audio_pipe]:
+            if os.path.exists(pipe):
+                os.remove(pipe)
+
+    for error in errors:
+        if isinstance(error, reraise):
+            raise error
+
+    if len(errors) > 0:
+        print(f"[Mux] Streaming input failed: {type(errors[0]).__name__}: {errors[0]}")
+        return False
+
+    if returncode != 0:
+        with open(log_file, 'r') as log:
+            error_lines = log.read().strip().splitlines()[-5:]
+        print(f"[Mux] ffmpeg failed with exit code {returncode}:")
+        for line in error_lines:
+            print(f"[Mux]   {line}")
+        return False
+
+    os.remove(log_file)
+    return True
@@ -0,0 +1,226 @@
+import threading
+import json
+import time
+import os
+
+from atomic import atomic_write
+from log_tailer import DirectoryWatch
+from log_tailer import RestartableThread
+
+def format_size(count, unit):
+    if unit != 'B':
+        return f"{count:.0f} {unit}"
+    for suffix in ['B', 'KB', 'MB', 'GB']:
+        if abs(count) < 1024:
+            return f"{count:.1f} {suffix}"
+        count /= 1024
+    return f"{count:.1f} TB"
+
+class JobProgress:
+    """Progress of one transfer. add() is cheap and safe to call from any thread."""
+    def __init__(self, tracker, job_id, name, total, done, unit, milestone, site=None):
+        self.Tracker = tracker
+        self.Id = job_id
+        self.Name = name
+        self.Site = site
+        self.Total = total
+        self.Done = done
+        self.Unit = unit
+        self.State = "running"
+        self.Started = time.time()
+        self.Finished = None
+        self.Rate = 0.0
+        self.Milestone = milestone
+        self.lock = threading.Lock()
+
+        # only what is transferred by this run counts towards the rate, not what was resumed
+        self.initial = done
+        self.next_milestone = self.milestone_after(done)
+        self.sample_done = done
+        self.sample_time = time.monotonic()
+
+    def milestone_after(self, done):
+        if self.Total <= 0:
+            return None
+        percent = done * 100 // self.Total
+        return (percent // self.Milestone + 1) * self.Milestone
+
+    def set_total(self, total):
+        with self.lock:
+            self.Total = total
+            self.next_milestone = self.milestone_after(self.Done)
+        self.Tracker.changed()
+
+    def add(self, count):
+        with self.lock:
+            self.Done += count
+            reached = None
+            if self.next_milestone is not None and self.next_milestone < 100 and self.Done * 100 >= self.next_milestone * self.Total:
+                reached = self.Done * 100 // self.Total
+                self.next_milestone = self.milestone_after(self.Done)
+        if self.Unit == 'B':
+            self.Tracker.transferred(self.Site, count)
+        self.Tracker.changed()
+        if reached is not None:
+            print(f"[Progress] {self.Name}: {reached}% of {format_size(self.Total, self.Unit)} at {self.average_rate_text()}")
+
+    def finish(self, succeeded=True):
+        with self.lock:
+            if self.State != "running":
+                return
+            self.State = "done" if succeeded else "failed"
+            self.Finished = time.time()
+        elapsed = self.Finished - self.Started
+        if succeeded:
+            print(f"[Progress] {self.Name}: done, {format_size(self.Done - self.initial, self.Unit)} in {elapsed:.0f}s at {self.average_rate_text()}")
+        else:
+            percent = f"{self.Done * 100 // self.Total}%" if self.Total > 0 else format_size(self.Done, self.Unit)
+            print(f"[Progress] {self.Name}: failed at {percent} after {elapsed:.0f}s")
+        self.Tracker.changed()
+
+    def average_rate_text(self):
+        elapsed = max(time.time() - self.Started, 0.001)
+        return f"{format_size((self.Done - self.initial) / elapsed, self.Unit)}/s"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.finish(exc_type is None)
+
+    def snapshot(self):
+        with self.lock:
+            # the rate is smoothed between snapshots so a single slow read doesnt make it jump around
+            now = time.monotonic()
+            elapsed = now - self.sample_time
+            if elapsed > 0 and self.State == "running":
+                current = (self.Done - self.sample_done) / elapsed
+                self.Rate = current if self.Rate == 0 else self.Rate * 0.7 + current * 0.3
+            self.sample_done = self.Done
+            self.sample_time = now
+
+            eta = None
+            if self.State == "running" and self.Rate > 0 and self.Total > 0:
+                eta = max(0, self.Total - self.Done) / self.Rate
+            return {
+                'id': self.Id,
+                'name': self.Name,
+                'site': self.Site,
+                'state': self.State,
+                'unit': self.Unit,
+                'done': self.Done,
+                'total': self.Total,
+                'percent': round(self.Done * 100 / self.Total, 1) if self.Total > 0 else None,
+                'rate': round(self.Rate, 1) if self.State == "running" else 0,
+                'eta': round(eta) if eta is not None else None,
+                'started': self.Started,
+                'finished': self.Finished,
+            }
+
+class ProgressTracker:
+    """Keeps the progress of every running transfer in memory.
+
+    Transfers only bump counters. Nothing is written per chunk: the log gets a
+    line at every milestone percent and, when a snapshot file is given, the
+    state of all jobs is written there as JSON at most once per interval for
+    the web server to pick up. Finished jobs stay in the snapshot for linger seconds.
+    on_bytes(site, count) is called for every byte count added, e.g. to feed metrics.
+    """
+    def __init__(self, snapshot_file=None, interval=1.0, milestone=25, linger=30, on_bytes=None):
+        self.SnapshotFile = snapshot_file
+        self.OnBytes = on_bytes
+        self.Interval = interval
+        self.Milestone = max(1, int(milestone))
+        self.Linger = linger
+        self.Jobs = {}
+        self.NextId = 1
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()
+        self.writer = None
+
+    def start(self, name, total=0, done=0, unit='B', site=None):
+        with self.lock:
+            job = JobProgress(self, self.NextId, name, total, done, unit, self.Milestone, site)
+            self.Jobs[job.Id] = job
+            self.NextId += 1
+            if self.SnapshotFile is not None and self.writer is None:
+                self.writer = threading.Thread(target=self.write_snapshots, daemon=True)
+                self.writer.start()
+        self.changed()
+        return job
+
+    def changed(self):
+        self.dirty.set()
+
+    def transferred(self, site, count):
+        if self.OnBytes is not None:
+            self.OnBytes(site, count)
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            # forget jobs that finished a while ago
+            for job_id, job in list(self.Jobs.items()):
+                if job.Finished is not None and now - job.Finished > self.Linger:
+                    del self.Jobs[job_id]
+            jobs = list(self.Jobs.values())
+        return {'updated': now, 'jobs': [job.snapshot() for job in jobs]}
+
+    def write_snapshots(self):
+        while True:
+            self.dirty.wait()
+            self.dirty.clear()
+            snapshot = self.snapshot()
+            try:
+                # the server never reads half a file
+                with atomic_write(self.SnapshotFile) as json_file:
+                    json.dump(snapshot, json_file)
+            except OSError as e:
+                print(f"[Progress] Unable to write {self.SnapshotFile}: {e}")
+
+            # keep rewriting while anything is running so rates and finished jobs age properly
+            if len(snapshot['jobs']) > 0:
+                self.dirty.set()
+            time.sleep(self.Interval)
+
+class ProgressWatcher(RestartableThread):
+    """Server side of the snapshot file. Calls on_progress with the parsed snapshot whenever it is replaced.
+
+    Restartable like LogTailer and only reads the file after it changed.
+    """
+    def __init__(self, filename, on_progress):
+        super().__init__()
+        self.Filename = os.path.abspath(filename)
+        self.OnProgress = on_progress
+        self.Latest = None
+        self.last_mtime = None
+
+    def latest(self):
+        # the last snapshot we read, refreshed from disk if the watcher isnt running
+        with self.lock:
+            if not self.is_alive():
+                self.read()
+        return self.Latest
+
+    def read(self):
+        try:
+            mtime = os.stat(self.Filename).st_mtime_ns
+            if mtime == self.last_mtime:
+                return False
+            with open(self.Filename, 'r') as json_file:
+                self.Latest = json.load(json_file)
+            self.last_mtime = mtime
+            return True
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return False
+
+    def run(self):
+        os.makedirs(os.path.dirname(self.Filename), exist_ok=True)
+        watch = DirectoryWatch(os.path.dirname(self.Filename))
+        try:
+            while not self.stop_event.is_set():
+                if self.read():
+                    self.OnProgress(self.Latest)
+                watch.wait(1.0)
+        finally:
+            watch.close()
@@ -0,0 +1,150 @@
+import threading
+import shutil
+import re
+import os
+
+from progress import format_size
+from transfer import get_part_files
+
+# download pages show decimal sizes, e.g. "4.21 GB"
+SizeUnits = {'B': 1, 'KB': 1e3, 'MB': 1e6, 'GB': 1e9, 'TB': 1e12}
+
+# HLS videos dont advertise a size, so it is guessed from the duration. mbit/s for at least this many lines
+EstimatedMbit = [(2160, 16), (1440, 9), (1080, 5), (720, 2.5), (480, 1.2), (0, 0.6)]
+
+def parse_size(text):
+    """Bytes in a size like "4.21 GB", or 0 when it cant be read."""
+    match = re.search(r'([\d.,]+)\s*([KMGT]?B)\b', str(text), re.IGNORECASE)
+    if match is None:
+        return 0
+    try:
+        return int(float(match.group(1).replace(',', '')) * SizeUnits[match.group(2).upper()])
+    except ValueError:
+        return 0
+
+def parse_height(text):
+    """Vertical resolution in a label like "1080p", "4K" or "8K 60fps", or None."""
+    text = str(text)
+    match = re.search(r'(\d{3,4})p', text, re.IGNORECASE)
+    if match is not None:
+        return int(match.group(1))
+    match = re.search(r'(\d+(?:\.\d+)?)\s*K\b', text, re.IGNORECASE)
+    if match is not None:
+        # 4K is 2160 lines, 8K is 4320
+        return int(float(match.group(1)) * 540)
+    return None
+
+def estimate_size(height, seconds):
+    for lines, mbit in EstimatedMbit:
+        if (height or 0) >= lines:
+            return int(mbit * 1000 * 1000 / 8 * seconds)
+    return 0
+
+class Option:
+    """One quality a site offers. A size of 0 means it is unknown."""
+    def __init__(self, label, height, size, source):
+        self.Label = label
+        self.Height = height
+        self.Size = size
+        self.Source = source
+
+class InsufficientSpace(Exception):
+    pass
+
+class Reservation:
+    """Space set aside for one download until it is in its final place.
+
+    Only the part that is not on disk yet counts, so a preallocated or half
+    finished download isnt counted twice against the free space.
+    """
+    def __init__(self, policy, device, size):
+        self.Policy = policy
+        self.Device = device
+        self.Size = size
+        self.Paths = []
+
+    def track(self, path):
+        """Count what is written to path (a file or a folder) as already used."""
+        self.Paths.append(path)
+
+    def on_disk(self):
+        used = 0
+        for path in self.Paths:
+            if os.path.isdir(path):
+                files = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+            else:
+                files = [path, get_part_files(path)[0]]
+            for filename in files:
+                try:
+                    used += os.path.getsize(filename)
+                except FileNotFoundError:
+                    pass
+        return used
+
+    def outstanding(self):
+        return max(0, self.Size - self.on_disk())
+
+    def release(self):
+        self.Policy.release(self)
+
+class QualityPolicy:
+    """Picks the best quality a site offers that fits under its ceilings and on disk.
+
+    Ceilings are a maximum size and a maximum height per site, 0 meaning none.
+    The free space of the output volume is reduced by min_free and by every
+    download that has been picked but is not finished yet, so a queue of large
+    videos cant overcommit the disk. Options are tried best first: highest
+    resolution, then largest file.
+    """
+    def __init__(self, settings):
+        self.MinFree = int(settings.get("min_free_gb", 0) * 1e9)
+        self.MaxSize = settings.get("max_size_gb", {})
+        self.MaxHeight = settings.get("max_height", {})
+        self.Reservations = []
+        self.lock = threading.Lock()
+
+    def allows(self, site, option):
+        max_size = self.MaxSize.get(site, 0)
+        if max_size > 0 and option.Size > max_size * 1e9:
+            return False
+        max_height = self.MaxHeight.get(site, 0)
+        if max_height > 0 and option.Height is not None and option.Height > max_height:
+            return False
+        return True
+
+    def free_space(self, directory):
+        # the output folder may not exist yet, what matters is the volume it will be on
+        directory = os.path.abspath(directory)
+        while not os.path.exists(directory):
+            directory = os.path.dirname(directory)
+        device = os.stat(directory).st_dev
+        reserved = sum(reservation.outstanding() for reservation in self.Reservations if reservation.Device == device)
+        return device, shutil.disk_usage(directory).free - reserved - self.MinFree
+
+    def choose(self, site, directory, options):
+        """The best option that fits and its Reservation, or (None, None) when every option is over the ceilings.
+
+        Raises InsufficientSpace when an option is allowed but none fit on disk.
+        """
+        allowed = [option for option in options if self.allows(site, option)]
+        if len(allowed) == 0:
+            if len(options) > 0:
+                print(f"[Quality] None of the {len(options)} {site} qualities are under the configured limits")
+            return None, None
+        allowed.sort(key=lambda option: (option.Height or 0, option.Size), reverse=True)
+
+        with self.lock:
+            device, available = self.free_space(directory)
+            for option in allowed:
+                if option.Size <= available:
+                    reservation = Reservation(self, device, option.Size)
+                    self.Reservations.append(reservation)
+                    return option, reservation
+
+        smallest = min(option.Size for option in allowed)
+        raise InsufficientSpace(f"{site} needs {format_size(smallest, 'B')} but only {format_size(max(0, available), 'B')} is free in {directory}")
+
+    def release(self, reservation):
+        with self.lock:
+            if reservation in self.Reservations:
+                self.Reservations.remove(reservation)
@@ -0,0 +1,185 @@
+import urllib.error
+import threading
+import requests
+import urllib3
+import random
+import socket
+import time
+
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# statuses that are worth asking again for. the rate limiting ones also pause the host
+RetryStatuses = [408, 425, 429, 500, 502, 503, 504]
+PauseStatuses = [429, 503]
+
+# connection level failures. anything else (a 404, a parse error, a private video) fails straight away
+RetryExceptions = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.TimeoutError,
+    urllib.error.URLError,
+    ConnectionError,
+    TimeoutError,
+    socket.timeout,
+)
+
+class HTTPStatusError(IOError):
+    """A response with a status we didnt ask for."""
+    def __init__(self, status, url, retry_after=None):
+        super().__init__(f"{url} answered {status}")
+        self.Status = status
+        self.Url = url
+        self.RetryAfter = retry_after
+
+class TransientError(IOError):
+    """A failure that will most likely go away when tried again, e.g. a body that ended early."""
+    pass
+
+def parse_retry_after(value):
+    # either a number of seconds or an http date
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def check_response(response, expected=(200,)):
+    """Return response if its status is expected, raise HTTPStatusError otherwise."""
+    if response.status_code in expected:
+        return response
+    response.close()
+    raise HTTPStatusError(response.status_code, response.url, parse_retry_after(response.headers.get('Retry-After')))
+
+def check_retriable(response):
+    """Return response unless its status is one worth retrying, which raises HTTPStatusError instead."""
+    if response.status_code not in RetryStatuses:
+        return response
+    response.close()
+    raise HTTPStatusError(response.status_code, response.url, parse_retry_after(response.headers.get('Retry-After')))
+
+def get_status(error):
+    if isinstance(error, HTTPStatusError):
+        return error.Status
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code
+    return None
+
+def is_retriable(error):
+    status = get_status(error)
+    if status is not None:
+        return status in RetryStatuses
+    return isinstance(error, (TransientError,) + RetryExceptions)
+
+def is_rate_limited(error):
+    status = get_status(error)
+    if status is not None:
+        return status in PauseStatuses
+    # phub turns a 429 page into a plain ConnectionError
+    return isinstance(error, ConnectionError) and '429' in str(error)
+
+def get_host(url):
+    return urlparse(url).hostname or url
+
+def backoff(attempt, base, maximum):
+    """Exponential delay for the attempt'th retry, jittered between half and all of it."""
+    delay = min(maximum, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class CircuitBreaker:
+    """Pauses one host after it rate limits us or fails threshold times in a row.
+
+    Every pause in a row is twice as long as the last, up to max_cooldown,
+    unless the server said how long with Retry-After. Callers wait out the
+    pause before their next request instead of adding to the pile.
+    """
+    def __init__(self, host, threshold, cooldown, max_cooldown):
+        self.Host = host
+        self.Threshold = max(1, int(threshold))
+        self.Cooldown = cooldown
+        self.MaxCooldown = max_cooldown
+        self.Failures = 0
+        self.Trips = 0
+        self.OpenUntil = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            remaining = self.OpenUntil - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def success(self):
+        with self.lock:
+            self.Failures = 0
+            self.Trips = 0
+
+    def failure(self, rate_limited, retry_after=None):
+        """Record a failed request. Returns how long the host is now paused for, 0 if it isnt."""
+        with self.lock:
+            self.Failures += 1
+            if not rate_limited and self.Failures < self.Threshold:
+                return 0
+            pause = retry_after if retry_after is not None else min(self.MaxCooldown, self.Cooldown * 2 ** self.Trips)
+            pause = min(self.MaxCooldown, pause)
+            self.Trips += 1
+            self.Failures = 0
+            self.OpenUntil = max(self.OpenUntil, time.monotonic() + pause)
+        print(f"[Retry] Pausing {self.Host} for {pause:.0f}s")
+        return pause
+
+class RetryPolicy:
+    """Runs network calls again when they fail in a way that is worth retrying.
+
+    Retriable errors are connection failures, timeouts, bodies that end early
+    and the statuses in RetryStatuses. Each retry waits an exponentially
+    growing, jittered delay. Every host has a CircuitBreaker shared by all
+    callers, so one worker being rate limited pauses the others on that host too.
+    """
+    def __init__(self, attempts=5, base_delay=1.0, max_delay=60.0, breaker_threshold=5, cooldown=30.0, max_cooldown=900.0):
+        self.Attempts = max(1, int(attempts))
+        self.BaseDelay = base_delay
+        self.MaxDelay = max_delay
+        self.BreakerThreshold = breaker_threshold
+        self.Cooldown = cooldown
+        self.MaxCooldown = max_cooldown
+        self.Breakers = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, host):
+        with self.lock:
+            breaker = self.Breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(host, self.BreakerThreshold, self.Cooldown, self.MaxCooldown)
+                self.Breakers[host] = breaker
+            return breaker
+
+    def call(self, url, fn, *args, **kwargs):
+        """fn(*args, **kwargs), tried up to Attempts times against the host of url."""
+        host = get_host(url)
+        breaker = self.breaker(host)
+        for attempt in range(self.Attempts):
+            breaker.wait()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_retriable(e):
+                    raise
+                breaker.failure(is_rate_limited(e), getattr(e, 'RetryAfter', None))
+                if attempt + 1 >= self.Attempts:
+                    raise
+                delay = backoff(attempt, self.BaseDelay, self.MaxDelay)
+                print(f"[Retry] {host}: {type(e).__name__}: {e}. Attempt {attempt + 2} of {self.Attempts} in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            breaker.success()
+            return result
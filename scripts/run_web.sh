@@ -1,3 +1,3 @@
 # /bin/bash
 
-python3 ./server.py -p 8008 -i ./www -o ../input -l ../logs/general.log
\ No newline at end of file
+python3 ./server.py -p 8008 -i ./www -o ../input -l ../logs/general.log -g ../logs/progress.json -j ../config/jobs.db -m ../logs/metrics.prom
\ No newline at end of file
@@ -0,0 +1,148 @@
+import threading
+import queue
+
+from threading import Thread
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+class Stage:
+    """One step of a Pipeline.
+
+    fn takes an item and returns the items for the next stage: a list, a
+    generator, or None for nothing. workers is either a single count shared by
+    every key or a dict with a count per key, e.g. per site. Each key gets its
+    own queue of at most queue_size items, so one busy site never blocks another.
+    """
+    def __init__(self, name, fn, workers, queue_size=2, default_workers=1):
+        self.Name = name
+        self.Fn = fn
+        self.Workers = workers
+        self.QueueSize = max(1, int(queue_size))
+        self.DefaultWorkers = default_workers
+        self.Queues = {}
+
+    def queue_key(self, key):
+        return key if isinstance(self.Workers, dict) else None
+
+    def worker_count(self, key):
+        if isinstance(self.Workers, dict):
+            return max(1, int(self.Workers.get(key, self.DefaultWorkers)))
+        return max(1, int(self.Workers))
+
+class Ticket:
+    """Everything that came out of one submitted item, however many items it fanned out into."""
+    def __init__(self, item):
+        self.Item = item
+        self.Results = []
+        self.Errors = []
+        self.Pending = 1
+        self.lock = threading.Lock()
+
+class Pipeline:
+    """Moves items through a chain of stages joined by bounded queues.
+
+    Every stage has its own workers, so while one item is being post-processed
+    the next can already be transferring and the one after that resolving.
+    A full queue blocks the stage feeding it, which keeps a fast stage from
+    running far ahead of a slow one. on_done(ticket) is called once an item and
+    everything it fanned out into has left the last stage.
+    """
+    def __init__(self, stages, key=lambda item: None, on_done=None):
+        self.Stages = stages
+        self.Key = key
+        self.OnDone = on_done
+        self.Open = 0
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+
+    def get_queue(self, index, key):
+        stage = self.Stages[index]
+        queue_key = stage.queue_key(key)
+        with self.lock:
+            work_queue = stage.Queues.get(queue_key)
+            if work_queue is None:
+                work_queue = queue.Queue(maxsize=stage.QueueSize)
+                stage.Queues[queue_key] = work_queue
+                for worker in range(stage.worker_count(key)):
+                    Thread(target=self.work, args=(index, work_queue), daemon=True, name=f"{stage.Name}-{queue_key}-{worker}").start()
+        return work_queue
+
+    def capacity(self, key):
+        """How many items can be submitted for key right now without blocking."""
+        work_queue = self.get_queue(0, key)
+        return max(0, work_queue.maxsize - work_queue.qsize())
+
+    def submit(self, item):
+        ticket = Ticket(item)
+        with self.lock:
+            self.Open += 1
+        self.get_queue(0, self.Key(item)).put((ticket, item))
+        return ticket
+
+    def work(self, index, work_queue):
+        stage = self.Stages[index]
+        last = index == len(self.Stages) - 1
+        while True:
+            ticket, item = work_queue.get()
+            try:
+                for output in stage.Fn(item) or []:
+                    if last:
+                        with ticket.lock:
+                            ticket.Results.append(output)
+                        continue
+                    with ticket.lock:
+                        ticket.Pending += 1
+                    self.get_queue(index + 1, self.Key(output)).put((ticket, output))
+            except Exception as e:
+                # one bad item should never take down the rest of the stage
+                print(f"[Pipeline] {stage.Name} failed: {type(e).__name__}: {e}")
+                with ticket.lock:
+                    ticket.Errors.append(e)
+            finally:
+                self.release(ticket)
+
+    def release(self, ticket):
+        with ticket.lock:
+            ticket.Pending -= 1
+            finished = ticket.Pending == 0
+        if not finished:
+            return
+
+        if self.OnDone is not None:
+            try:
+                self.OnDone(ticket)
+            except Exception as e:
+                print(f"[Pipeline] Finishing failed: {type(e).__name__}: {e}")
+        with self.lock:
+            self.Open -= 1
+            if self.Open == 0:
+                self.idle.notify_all()
+
+    def wait(self):
+        with self.lock:
+            while self.Open > 0:
+                self.idle.wait()
+
+def prefetch(items, fn, depth):
+    """Yield fn(item) for every item, in order, while up to depth items ahead are resolved on a pool.
+
+    items can be a lazy generator. It is only pulled as far as depth ahead of the
+    consumer, so memory stays flat however long it is. Items whose fn raised yield None.
+    """
+    depth = max(1, int(depth))
+
+    def run(item):
+        try:
+            return fn(item)
+        except Exception as e:
+            print(f"[Prefetch] Failed resolving {item}: {type(e).__name__}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=depth, thread_name_prefix="prefetch") as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(run, item))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
@@ -5,8 +5,12 @@ import threading
 import time
 import os
 
-from threading import Thread
-from flask import Flask, request, jsonify, render_template
+from log_tailer import LogTailer
+from progress import ProgressWatcher
+from jobs import JobStore
+from jobs import FinalStates
+from jobs import QUEUED, RETRYING, ActiveStates
+from flask import Flask, request, jsonify, render_template, Response
 from flask_socketio import SocketIO
 
 parser = argparse.ArgumentParser(description="Verify and save valid URLs from a file.")
@@ -14,28 +18,18 @@ parser.add_argument("-p", "--port", help="Desired port", required=False, default
 parser.add_argument("-i", "--public-dir", help="Directory that contains our index.html", required=True)
 parser.add_argument("-o", "--output-dir", help="Output directory for files we save", required=True)
 parser.add_argument("-l", "--log-to-read", help="Log file we might want to monitor", required=False)
+parser.add_argument("-j", "--jobs-db", help="Job store shared with download.py, usually ../config/jobs.db", required=False)
+parser.add_argument("-g", "--progress-file", help="Progress snapshot written by download.py --progress-file", required=False)
+parser.add_argument("-m", "--metrics-file", help="Metrics written by download.py --metrics-file", required=False)
+parser.add_argument("--log-history", help="How many recent log lines to keep in memory", type=int, default=1000)
+parser.add_argument("--log-replay", help="How many recent log lines a new client is sent", type=int, default=200)
 args = parser.parse_args()
 
 class SharedResource:
     def __init__(self):
         self.num_connected = 0
-        self.thread_running = False
         self.lock = threading.Lock()
 
-    def thread_on(self):
-        with self.lock:
-            self.thread_running = True
-        
-    def thread_off(self):
-        with self.lock:
-            self.thread_running = False
-
-    def is_thread_on(self):
-        value = False
-        with self.lock:
-            value = self.thread_running
-        return value
-        
     def add_num_connected(self, value):
         new_value = 0
         with self.lock:
@@ -52,35 +46,26 @@ class SharedResource:
         with self.lock:
             value = self.num_connected 
         return value
-            
-
-def read_log(data):
-    data.thread_on()
-    print("Opening read_log thread")
-    print(f"Monitoring Log: {args.log_to_read}")
-    last_position = 0
-    while data.get_num_connected() > 0:
-        try:
-            with open(args.log_to_read, 'r') as log_file:
-                log_file.seek(last_position)
-                new_lines = [line.strip() for line in log_file.readlines() if line.strip()]
 
-                if new_lines:
-                    socketio.emit('update_log', {'new_lines': new_lines})
+def broadcast_log(first_line, new_lines):
+    # one emit per batch goes to every connected client, the file is only read once
+    socketio.emit('update_log', {'first_line': first_line, 'new_lines': new_lines})
 
-                last_position = log_file.tell()  # Update the last position to the current position in the file
-        except FileNotFoundError:
-            new_lines = f"Log File {args.log_to_read} not found."
-            print(new_lines)
-            socketio.emit('update_log', {'new_lines': new_lines})
-            break
-    print("closing read_log thread")
-    data.thread_off()
+def broadcast_progress(snapshot):
+    socketio.emit('update_progress', snapshot)
 
 app = Flask(__name__, template_folder=args.public_dir)
 socketio = SocketIO(app)
 num_connected = SharedResource()
-log_thread = Thread(target=read_log, daemon=True, args=(num_connected,))
+log_tailer = None
+if args.log_to_read is not None and args.log_to_read != "":
+    log_tailer = LogTailer(args.log_to_read, broadcast_log, history=args.log_history)
+job_store = None
+if args.jobs_db is not None and args.jobs_db != "":
+    job_store = JobStore(args.jobs_db)
+progress_watcher = None
+if args.progress_file is not None and args.progress_file != "":
+    progress_watcher = ProgressWatcher(args.progress_file, broadcast_progress)
 
 @app.route('/')
 def index():
@@ -91,31 +76,157 @@ def save_text():
     try:
         data = request.get_json()
         text = data['text']
+        if job_store is not None:
+            ids, invalid = job_store.add(text.split('\n'))
+            return jsonify({'message': f'Queued {len(ids)} urls.', 'ids': ids, 'invalid': invalid})
         with tempfile.NamedTemporaryFile(dir=args.output_dir, delete=False, mode='w') as temp_file:
             temp_file.write(text)
         return jsonify({'message': 'Submitted successfully.'})
     except Exception as e:
         return jsonify({'error': str(e)})
 
+def no_job_store():
+    return jsonify({'error': 'No job store configured. Start the server with --jobs-db.'}), 404
+
+@app.route('/jobs', methods=['POST'])
+def add_jobs():
+    # {"urls": [...]} or {"text": "one url per line"}, with an optional "priority". higher runs first
+    if job_store is None:
+        return no_job_store()
+    data = request.get_json(silent=True) or {}
+    urls = data.get('urls')
+    if urls is None:
+        urls = str(data.get('text', '')).split('\n')
+    if not isinstance(urls, list):
+        return jsonify({'error': '"urls" must be a list.'}), 400
+    try:
+        priority = int(data.get('priority', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': '"priority" must be a number.'}), 400
+
+    ids, invalid = job_store.add([str(url) for url in urls], priority)
+    return jsonify({'message': f'Queued {len(ids)} urls.', 'ids': ids, 'invalid': invalid})
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    # newest first. page with ?before=<smallest id already shown>
+    if job_store is None:
+        return no_job_store()
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+        before = request.args.get('before')
+        jobs = job_store.list(state=request.args.get('state'), before=int(before) if before else None, limit=limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'jobs': jobs, 'counts': job_store.counts()})
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    if job_store is None:
+        return no_job_store()
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Job {job_id} not found.'}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+@app.route('/jobs/<int:job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    if job_store is None:
+        return no_job_store()
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Job {job_id} not found.'}), 404
+    if job['state'] in FinalStates:
+        return jsonify({'error': f'Job {job_id} is already {job["state"]}.'}), 409
+    job_store.cancel(job_id)
+    return jsonify(job_store.get(job_id))
+
+@app.route('/log', methods=['GET'])
+def get_log():
+    # pages through the in-memory history, offset is a line number as sent with update_log
+    if log_tailer is None:
+        return jsonify({'error': 'No log is being monitored.'}), 404
+    log_tailer.refresh()
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 0), args.log_history)
+        if 'offset' in request.args:
+            first_line, lines = log_tailer.page(int(request.args['offset']), limit)
+        else:
+            first_line, lines = log_tailer.recent(limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'first_line': first_line, 'lines': lines, 'next_line': first_line + len(lines)})
+
+@app.route('/progress', methods=['GET'])
+def get_progress():
+    if progress_watcher is None:
+        return jsonify({'error': 'No progress file is being monitored.'}), 404
+    snapshot = progress_watcher.latest()
+    return jsonify(snapshot if snapshot is not None else {'jobs': []})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # the downloader's own numbers, plus what only the job store knows
+    lines = []
+    if args.metrics_file is not None and args.metrics_file != "":
+        try:
+            with open(args.metrics_file, 'r') as metrics_file:
+                lines.append(metrics_file.read().rstrip('\n'))
+            lines.append("# HELP downloader_metrics_age_seconds Seconds since the downloader last wrote its metrics.")
+            lines.append("# TYPE downloader_metrics_age_seconds gauge")
+            lines.append(f"downloader_metrics_age_seconds {time.time() - os.path.getmtime(args.metrics_file):.1f}")
+        except FileNotFoundError:
+            pass
+
+    if job_store is not None:
+        counts = job_store.counts()
+        lines.append("# HELP downloader_queue_depth Jobs waiting to be claimed by the downloader.")
+        lines.append("# TYPE downloader_queue_depth gauge")
+        lines.append(f"downloader_queue_depth {counts.get(QUEUED, 0)}")
+        lines.append("# HELP downloader_jobs Jobs in the job store by state.")
+        lines.append("# TYPE downloader_jobs gauge")
+        for state in [QUEUED, RETRYING] + ActiveStates + FinalStates:
+            lines.append(f'downloader_jobs{{state="{state}"}} {counts.get(state, 0)}')
+
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
 @socketio.on('connect')
 def handle_connect():
     print('Client connected')
-    if num_connected.add_num_connected(1) == 1 and not num_connected.is_thread_on():
-        if args.log_to_read is not None and args.log_to_read != "":
-            log_thread.start()   
+    if num_connected.add_num_connected(1) == 1:
+        if log_tailer is not None:
+            log_tailer.start()
+        if progress_watcher is not None:
+            progress_watcher.start()
+
+    if progress_watcher is not None and progress_watcher.Latest is not None:
+        socketio.emit('update_progress', progress_watcher.Latest, to=request.sid)
+
+    if log_tailer is None:
+        return
+
+    # catch the new client up from memory, everyone else already has these lines
+    first_line, lines = log_tailer.recent(args.log_replay)
+    socketio.emit('update_log', {'first_line': first_line, 'new_lines': lines, 'replay': True}, to=request.sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     print('Client disconnected')
-    if num_connected.add_num_connected(-1) == 0 and num_connected.is_thread_on():
-        if args.log_to_read is not None and args.log_to_read != "":
-            log_thread.join()
+    if num_connected.add_num_connected(-1) == 0:
+        # don't block the disconnect handler, the threads notice within a second
+        if log_tailer is not None:
+            log_tailer.stop()
+        if progress_watcher is not None:
+            progress_watcher.stop()
 
 if __name__ == '__main__':
     print("Starting Flask Server")
     app.run(host='0.0.0.0', port=args.port, debug=False)
 
-    if num_connected.is_thread_on():
-        num_connected.set_num_connected(0)
-        log_thread.join()
+    num_connected.set_num_connected(0)
+    if log_tailer is not None:
+        log_tailer.stop(wait=True)
+    if progress_watcher is not None:
+        progress_watcher.stop(wait=True)
 
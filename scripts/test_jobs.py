@@ -0,0 +1,43 @@
+import unittest
+import tempfile
+import os
+
+from jobs import JobStore
+from jobs import DONE, QUEUED, RESOLVING
+
+class JobStoreAddTest(unittest.TestCase):
+    def setUp(self):
+        self.store = JobStore(os.path.join(tempfile.mkdtemp(), "jobs.db"))
+        self.url = "https://vrporn.com/some-video/"
+
+    def test_same_url_twice_is_one_job(self):
+        first, _ = self.store.add([self.url])
+        second, _ = self.store.add([self.url])
+        self.assertEqual(first, second)
+
+        claimed = self.store.claim("vrporn", 10)
+        self.assertEqual([job['id'] for job in claimed], first)
+        self.assertEqual(self.store.claim("vrporn", 10), [])
+
+    def test_same_url_twice_in_one_batch_is_one_job(self):
+        ids, _ = self.store.add([self.url, self.url])
+        self.assertEqual(ids[0], ids[1])
+        self.assertEqual(len(self.store.claim("vrporn", 10)), 1)
+
+    def test_running_job_is_not_queued_again(self):
+        ids, _ = self.store.add([self.url])
+        self.store.claim("vrporn", 10)
+        again, _ = self.store.add([self.url])
+        self.assertEqual(again, ids)
+        self.assertEqual(self.store.get(ids[0])['state'], RESOLVING)
+
+    def test_finished_url_can_be_queued_again(self):
+        ids, _ = self.store.add([self.url])
+        self.store.claim("vrporn", 10)
+        self.store.set_state(ids[0], DONE)
+        again, _ = self.store.add([self.url])
+        self.assertNotEqual(again, ids)
+        self.assertEqual(self.store.get(again[0])['state'], QUEUED)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import threading
+import unittest
+import tempfile
+import stat
+import time
+import sys
+import os
+
+from types import SimpleNamespace
+
+# download.py reads its arguments and config dir on import
+config_dir = tempfile.mkdtemp()
+sys.argv = ['download.py', '-c', config_dir, '-i', os.devnull]
+import download
+
+from jobs import JobCancelled
+
+# stands in for ffmpeg: reads every input to the end, then writes the output
+FakeFFmpeg = """#!{python}
+import sys
+args = sys.argv[1:]
+for index, arg in enumerate(args):
+    if arg == '-i':
+        with open(args[index + 1], 'rb') as source:
+            while source.read(65536):
+                pass
+with open(args[-1], 'wb') as output:
+    output.write(b'muxed')
+"""
+
+class FakeDownloader:
+    """Streams zeros through the job's throttle, the way RangeDownloader.stream does."""
+    def __init__(self, job_id):
+        self.Throttle = download.get_bandwidth(job_id).throttle("youtube")
+        self.Downloads = []
+
+    def stream(self, url, file, name="stream"):
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            file.write(bytes(64 * 1024))
+            self.Throttle(64 * 1024)
+            time.sleep(0.01)
+
+    def download(self, url, destination):
+        self.Downloads.append(url)
+
+class StreamingMuxCancelTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.work_dir, "bin")
+        os.makedirs(bin_dir)
+        ffmpeg = os.path.join(bin_dir, "ffmpeg")
+        with open(ffmpeg, 'w') as script:
+            script.write(FakeFFmpeg.format(python=sys.executable))
+        os.chmod(ffmpeg, os.stat(ffmpeg).st_mode | stat.S_IEXEC)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = f"{bin_dir}{os.pathsep}{self.path}"
+        self.streaming_mux = download.Settings["youtube"]["streaming_mux"]
+        download.Settings["youtube"]["streaming_mux"] = True
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        download.Settings["youtube"]["streaming_mux"] = self.streaming_mux
+
+    def test_cancel_during_streaming_mux_does_not_fall_back(self):
+        url = "https://www.youtube.com/watch?v=cancelmux01"
+        ids, _ = download.jobs.add([url])
+        job_id = ids[0]
+        self.assertEqual([job['id'] for job in download.jobs.claim("youtube", 1)], [job_id])
+
+        downloaders = []
+        def get_range_downloader(site, job_id=None):
+            downloaders.append(FakeDownloader(job_id))
+            return downloaders[-1]
+        original = download.get_range_downloader
+        download.get_range_downloader = get_range_downloader
+
+        task = download.GrabTask("youtube", url, os.path.join(self.work_dir, "out"), job_id)
+        task.Source = SimpleNamespace(video_id="cancelmux01", title="Cancel Mux", captions=[])
+        task.Parts = (SimpleNamespace(url="https://video.invalid/v"), SimpleNamespace(url="https://audio.invalid/a"))
+        task.FinalName = "cancel_mux.mp4"
+        task.Reservation = SimpleNamespace(track=lambda path: None)
+
+        threading.Timer(0.3, download.jobs.cancel, args=(job_id,)).start()
+        started = time.monotonic()
+        try:
+            with self.assertRaises(JobCancelled):
+                download.TransferYT(task)
+        finally:
+            download.get_range_downloader = original
+
+        # stopped at the first cancellation check instead of streaming on or downloading the parts
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual([downloads for downloader in downloaders for downloads in downloader.Downloads], [])
+        self.assertTrue(download.jobs.is_cancelled(job_id))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,370 @@
+import threading
+import requests
+import errno
+import json
+import os
+
+from atomic import atomic_write
+from progress import ProgressTracker
+from bandwidth import LimitedChunk
+from retry import RetryPolicy
+from retry import TransientError
+from retry import check_response
+from retry import check_retriable
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+# partial downloads live next to their destination as <file>.part with a <file>.part.json
+# sidecar describing what has already been written, so a restart can pick up where it left off
+def get_part_files(destination):
+    part_file = f"{destination}.part"
+    return part_file, f"{part_file}.json"
+
+def load_state(state_file):
+    try:
+        with open(state_file, 'r') as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return None
+    except json.decoder.JSONDecodeError:
+        print(f"[Transfer] {state_file} has invalid JSON. Starting over.")
+        return None
+
+def save_state(state_file, state):
+    # a crash never leaves a half written sidecar
+    with atomic_write(state_file) as json_file:
+        json.dump(state, json_file)
+
+def remove_state(state_file):
+    if os.path.exists(state_file):
+        os.remove(state_file)
+
+# ask servers for the raw bytes so the body can be read straight into our buffer
+StreamHeaders = {'Accept-Encoding': 'identity'}
+
+def stream_into(response, file, buffer, on_bytes=None, throttle=None):
+    """Copy a streamed response body into file through one reusable buffer.
+
+    Reads whole blocks with readinto instead of iterating small chunks, so a
+    multi GB file costs a few thousand writes rather than millions.
+    throttle(count) is called after every read and may sleep to hold a bandwidth
+    limit. While it reports a limit, reads shrink so streams share fairly.
+    """
+    response.raw.decode_content = True
+    view = memoryview(buffer)
+    read_view = view
+    written = 0
+    while True:
+        count = response.raw.readinto(read_view)
+        if not count:
+            break
+        file.write(read_view[:count])
+        written += count
+        if on_bytes is not None:
+            on_bytes(count)
+        if throttle is not None:
+            read_view = view[:LimitedChunk] if throttle(count) else view
+    return written
+
+def preallocate(file, size):
+    """Reserve size bytes on disk up front.
+
+    fallocate keeps the file contiguous and fails right away with ENOSPC instead
+    of hours into the download. Filesystems without it just get a sparse file.
+    """
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+        return
+    except AttributeError:
+        pass
+    except OSError as e:
+        if e.errno not in [errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL]:
+            raise
+    file.truncate(size)
+
+class RangeState:
+    """Completed byte ranges of a partial download, kept merged and sorted."""
+    def __init__(self, state_file, size, done=None):
+        self.StateFile = state_file
+        self.Size = size
+        self.Done = done if done is not None else []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load(state_file, size):
+        state = load_state(state_file)
+        if state is None or state.get('size') != size:
+            return None
+        return RangeState(state_file, size, [list(byte_range) for byte_range in state.get('done', [])])
+
+    def completed_bytes(self):
+        return sum(end - start + 1 for start, end in self.Done)
+
+    def missing(self):
+        gaps = []
+        position = 0
+        for start, end in self.Done:
+            if start > position:
+                gaps.append((position, start - 1))
+            position = max(position, end + 1)
+        if position < self.Size:
+            gaps.append((position, self.Size - 1))
+        return gaps
+
+    def add(self, start, end):
+        with self.lock:
+            merged = []
+            for done_start, done_end in sorted(self.Done + [[start, end]]):
+                if merged and done_start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], done_end)
+                else:
+                    merged.append([done_start, done_end])
+            self.Done = merged
+            save_state(self.StateFile, {'size': self.Size, 'done': self.Done})
+
+class RangeDownloader:
+    """Downloads a url over several parallel HTTP Range requests.
+
+    The file is split into fixed size segments which are fetched by a pool of
+    connections and written straight to their offset in a preallocated file.
+    Finished segments are recorded in a sidecar so an interrupted download
+    resumes with only the missing ranges. Servers that do not answer a range
+    probe fall back to a single stream. Progress is reported to a ProgressTracker
+    and, given a BandwidthLimiter, every read is counted against the site's share.
+    Requests go through a RetryPolicy and a failed range continues after the
+    last byte that made it to disk.
+    """
+    def __init__(self, session=None, segments=4, segment_size=64 * 1024 * 1024, buffer_size=1024 * 1024, progress=None, site=None, bandwidth=None, retry=None):
+        self.Session = session if session is not None else requests
+        self.Progress = progress if progress is not None else ProgressTracker()
+        self.Retry = retry if retry is not None else RetryPolicy()
+        self.Site = site
+        self.Throttle = bandwidth.throttle(site) if bandwidth is not None else None
+        self.Segments = max(1, int(segments))
+        self.SegmentSize = max(1, int(segment_size))
+        self.BufferSize = max(4096, int(buffer_size))
+        self.local = threading.local()
+
+    def get_buffer(self):
+        # one buffer per worker thread, reused for every segment it fetches
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None or len(buffer) != self.BufferSize:
+            buffer = bytearray(self.BufferSize)
+            self.local.buffer = buffer
+        return buffer
+
+    def probe(self, url):
+        return self.Retry.call(url, self.send_probe, url)
+
+    def send_probe(self, url):
+        # ask for the first byte only. a 206 with a full Content-Range means ranges work and tells us the size
+        response = self.Session.get(url, headers={'Range': 'bytes=0-0'}, stream=True)
+        check_retriable(response).close()
+        if response.status_code != 206:
+            return None
+
+        # Content-Range: bytes 0-0/12345
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        if not total.isdigit():
+            return None
+        return int(total)
+
+    def split(self, gaps):
+        ranges = []
+        for gap_start, gap_end in gaps:
+            for start in range(gap_start, gap_end + 1, self.SegmentSize):
+                ranges.append((start, min(start + self.SegmentSize - 1, gap_end)))
+        return ranges
+
+    def download(self, url, destination):
+        part_file, state_file = get_part_files(destination)
+
+        total_size = self.probe(url)
+        if total_size is None:
+            # without ranges there is nothing we can resume
+            remove_state(state_file)
+            self.download_single(url, part_file)
+            os.replace(part_file, destination)
+            print(f"File downloaded successfully to {destination}")
+            return True
+
+        if os.path.exists(destination) and os.path.getsize(destination) == total_size and not os.path.exists(state_file):
+            print(f"[Transfer] {destination} is already complete")
+            return True
+
+        state = None
+        if os.path.exists(part_file) and os.path.getsize(part_file) == total_size:
+            state = RangeState.load(state_file, total_size)
+
+        if state is None:
+            # preallocate so every segment can write at its own offset
+            state = RangeState(state_file, total_size)
+            with open(part_file, 'wb') as file:
+                preallocate(file, total_size)
+            save_state(state_file, {'size': total_size, 'done': []})
+        elif state.completed_bytes() > 0:
+            print(f"[Transfer] Resuming {destination} at {state.completed_bytes()} of {total_size} bytes")
+
+        ranges = self.split(state.missing())
+        print(f"[Transfer] Fetching {destination} in {len(ranges)} segments over {self.Segments} connections")
+
+        with self.Progress.start(os.path.basename(destination), total=total_size, done=state.completed_bytes(), site=self.Site) as progress:
+            def fetch(byte_range):
+                self.fetch_range(url, part_file, byte_range, progress.add)
+                state.add(*byte_range)
+
+            with ThreadPoolExecutor(max_workers=self.Segments) as pool:
+                # list() so the first failed segment raises here
+                list(pool.map(fetch, ranges))
+
+        os.replace(part_file, destination)
+        remove_state(state_file)
+        print(f"File downloaded successfully to {destination}")
+        return True
+
+    def open_stream(self, url, headers=None, expected=(200,)):
+        response = self.Session.get(url, headers={**StreamHeaders, **(headers or {})}, stream=True)
+        return check_response(response, expected)
+
+    def copy_range(self, url, file, byte_range, on_bytes, seek):
+        """Write byte_range of url into file. A retry asks for the rest of the range only."""
+        start, end = byte_range
+        position = [start]
+
+        def counted(count):
+            position[0] += count
+            on_bytes(count)
+
+        def attempt():
+            with self.open_stream(url, {'Range': f'bytes={position[0]}-{end}'}, expected=(206,)) as response:
+                if seek:
+                    file.seek(position[0])
+                stream_into(response, file, self.get_buffer(), counted, self.Throttle)
+            if position[0] != end + 1:
+                raise TransientError(f"Range {start}-{end} is short. Got {position[0] - start} of {end - start + 1} bytes")
+
+        self.Retry.call(url, attempt)
+
+    def fetch_range(self, url, destination, byte_range, on_bytes):
+        with open(destination, 'r+b') as file:
+            self.copy_range(url, file, byte_range, on_bytes, seek=True)
+
+    def download_single(self, url, destination):
+        # without ranges a failed attempt has to start over
+        self.Retry.call(url, self.fetch_single, url, destination)
+
+    def fetch_single(self, url, destination):
+        response = self.open_stream(url)
+        total_size = int(response.headers.get('content-length', 0))
+
+        with open(destination, 'wb') as file, response, self.Progress.start(os.path.basename(destination), total=total_size, site=self.Site) as progress:
+            preallocate(file, total_size)
+            written = stream_into(response, file, self.get_buffer(), progress.add, self.Throttle)
+
+            # drop any preallocated space the body didnt fill
+            file.truncate(written)
+
+        if total_size > 0 and written != total_size:
+            raise TransientError(f"{url} is short. Got {written} of {total_size} bytes")
+
+    def stream(self, url, file, name="stream"):
+        # write the whole body in order into an already open file, e.g. a pipe. nothing is
+        # written to disk so this cannot resume, but the reader gets bytes as soon as they arrive
+        total_size = self.probe(url)
+        if total_size is None:
+            # bytes already sent down the pipe cant be taken back, so only the request is retried
+            response = self.Retry.call(url, self.open_stream, url)
+            with response, self.Progress.start(name, total=int(response.headers.get('content-length', 0)), site=self.Site) as progress:
+                stream_into(response, file, self.get_buffer(), progress.add, self.Throttle)
+            return
+
+        with self.Progress.start(name, total=total_size, site=self.Site) as progress:
+            for byte_range in self.split([(0, total_size - 1)]):
+                self.copy_range(url, file, byte_range, progress.add, seek=False)
+
+class HLSDownloader:
+    """phub downloader backend that appends HLS segments to a resumable part file.
+
+    phub's default backend fetches one segment after another and keeps the
+    whole video in memory until the end. This one keeps up to workers segments
+    in flight, so a slow round trip no longer caps the throughput, and writes
+    them in playlist order as they arrive. Only a window of segments past the
+    one being written is fetched ahead, which bounds the memory used while an
+    early segment is slow. The number of segments written is recorded after
+    each one, so a restart continues from the next segment as long as it is
+    still the same quality.
+    Progress goes to a ProgressTracker rather than phub's per segment display.
+    Segments arrive whole, so a BandwidthLimiter is paid after each one.
+    The playlist and every segment are fetched through a RetryPolicy.
+    Use as video.download(path, quality, downloader=HLSDownloader()).
+    """
+    def __init__(self, timeout=10, progress=None, site=None, bandwidth=None, retry=None, workers=4):
+        self.Timeout = timeout
+        self.Progress = progress if progress is not None else ProgressTracker()
+        self.Retry = retry if retry is not None else RetryPolicy()
+        self.Site = site
+        self.Throttle = bandwidth.throttle(site) if bandwidth is not None else None
+        self.Workers = max(1, int(workers))
+
+        # segments fetched ahead of the next one to write. a few per worker keeps them all busy
+        # while one segment is slow without holding much of the video in memory
+        self.Window = self.Workers * 2
+
+    def fetch_segment(self, video, url):
+        def attempt():
+            response = video.client.call(url, throw=False, timeout=self.Timeout, silent=True)
+            return check_response(response).content
+        data = self.Retry.call(url, attempt)
+        self.Progress.transferred(self.Site, len(data))
+        if self.Throttle is not None:
+            self.Throttle(len(data))
+        return data
+
+    def __call__(self, video, quality, callback, path, start=0):
+        part_file, state_file = get_part_files(path)
+        segments = self.Retry.call(video.url, lambda: list(video.get_segments(quality)))
+
+        # every quality has the same number of segments, so the playlist itself tells them apart.
+        # its query string is a signature that changes with every page load
+        playlist = urlparse(self.Retry.call(video.url, video.get_M3U_URL, quality)).path
+
+        # only trust the sidecar if it describes the same playlist and the part file has all of it
+        done = 0
+        size = 0
+        state = load_state(state_file)
+        if state is not None and state.get('playlist') != playlist:
+            print(f"[Transfer] {path} was started in another quality. Starting over.")
+        elif state is not None and state.get('segments') == len(segments) and os.path.exists(part_file) and os.path.getsize(part_file) >= state.get('size', 0):
+            done = state['done']
+            size = state['size']
+            print(f"[Transfer] Resuming {path} at segment {done} of {len(segments)}")
+
+        pool = ThreadPoolExecutor(max_workers=self.Workers)
+        try:
+            with open(part_file, 'r+b' if done > 0 else 'wb') as file, self.Progress.start(os.path.basename(path), total=len(segments), done=done, unit='segments', site=self.Site) as progress:
+                file.truncate(size)
+                file.seek(size)
+
+                # segments finish in any order. the futures are the reorder buffer and get written by index
+                pending = {}
+                next_fetch = done
+                for index in range(done, len(segments)):
+                    while next_fetch < len(segments) and next_fetch < index + self.Window:
+                        pending[next_fetch] = pool.submit(self.fetch_segment, video, segments[next_fetch])
+                        next_fetch += 1
+
+                    data = pending.pop(index).result()
+                    file.write(data)
+                    file.flush()
+
+                    size += len(data)
+                    save_state(state_file, {'playlist': playlist, 'segments': len(segments), 'done': index + 1, 'size': size})
+                    progress.add(1)
+        finally:
+            # a failed segment stops the rest. whatever was written in order is kept for the next attempt
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        os.replace(part_file, path)
+        remove_state(state_file)
@@ -1,30 +1,116 @@
+import hashlib
 import json
+import time
+import os
 import requests
-from tqdm import tqdm
 from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
+from bs4 import ElementFilter
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+from transfer import RangeDownloader
+from transfer import StreamHeaders
+from transfer import stream_into
+
+from retry import RetryPolicy
+from retry import check_retriable
+
+from quality import parse_size
+from quality import parse_height
+from atomic import atomic_write
+
+# lxml is much faster when it is installed. html.parser is always there
+try:
+    import lxml
+    HTMLParser = 'lxml'
+except ImportError:
+    HTMLParser = 'html.parser'
+
+# classes of the elements parse() reads. an element matches when any of its classes is one of these
+PageClasses = {'content-title', 'download-links-popup', 'list_row'}
+
+class PageStrainer(ElementFilter):
+    """Only builds the few elements we read (and what is inside them) into a tree instead of the whole page.
+
+    Matches class tokens like find(class_=...) does, so <h1 class="content-title big"> is kept.
+    """
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        attrs = attrs or {}
+        if name == 'a' and attrs.get('id') == 'studio-logo':
+            return True
+        classes = attrs.get('class', '')
+        if isinstance(classes, str):
+            classes = classes.split()
+        return not PageClasses.isdisjoint(classes)
+
+    def allow_string_creation(self, string):
+        # text outside of the elements above is never read
+        return False
+
+AccountStrainer = SoupStrainer('div', class_='account-displayname')
 
 class VRP_Authenticate:
-    def __init__(self, username, password):
+    def __init__(self, username, password, pool_size=16, retry=None):
         self.Username = username
         self.Password = password
         self.BaseURL = "https://vrporn.com"
         self.LoginURL = f"{self.BaseURL}/login"
-        self.Cookies = {}
+
+        # one keep-alive session for every page fetch and download so connections get reused.
+        # its cookie jar holds the login and is what gets saved to the cookie cache
+        self.Session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.Session.mount("https://", adapter)
+        self.Session.mount("http://", adapter)
+
+        # when the login was last confirmed. lets us skip the /account check while it is still fresh
+        self.ValidatedAt = None
+
+        # every request to the site goes through this, so pages and downloads share the per host pause
+        self.Retry = retry if retry is not None else RetryPolicy()
+
+    def Get(self, url, **kwargs):
+        # rate limits and server errors are retried, any other status is for the caller to handle
+        return self.Retry.call(url, lambda: check_retriable(self.Session.get(url, **kwargs)))
+
+    @property
+    def Cookies(self):
+        return self.Session.cookies.get_dict()
+
+    def SetCookies(self, cookies):
+        # scope the cookies to the site so they are not sent along to the download servers
+        domain = urlparse(self.BaseURL).hostname
+        for name, value in cookies.items():
+            self.Session.cookies.set(name, value, domain=domain)
 
     def SaveCookies(self, filename):
         with open(filename, 'w') as json_file:
-            json.dump(self.Cookies, json_file)
+            json.dump({'cookies': self.Cookies, 'validated_at': self.ValidatedAt}, json_file)
     
     def LoadCookies(self, filename):
         try:
             with open(filename, 'r') as json_file:
-                self.Cookies = json.load(json_file)
+                cache = json.load(json_file)
+
+            # older caches (and hand written ones) are just the cookies
+            if 'cookies' in cache:
+                self.SetCookies(cache['cookies'])
+                self.ValidatedAt = cache.get('validated_at')
+            else:
+                self.SetCookies(cache)
             #print(f"Loaded Cookies: {self.Cookies}")
         except FileNotFoundError:
             print(f"{filename} not found")
         except json.decoder.JSONDecodeError:
             print(f"{filename} has invalid JSON")
 
+    def IsValidationFresh(self, ttl):
+        return self.ValidatedAt is not None and time.time() - self.ValidatedAt < ttl
+
+    def Invalidate(self):
+        self.ValidatedAt = None
+
     def IsAuthenticated(self):
         def remove_all_whitespace(s):
             return s.replace(" ", "").replace("\t", "").replace("\n", "").replace("\r", "")
@@ -32,10 +118,10 @@ class VRP_Authenticate:
         url = f"{self.BaseURL}/account"
 
         # Fetch the webpage
-        response = requests.get(url, cookies=self.Cookies)
+        response = self.Get(url)
 
         if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
+            soup = BeautifulSoup(response.text, HTMLParser, parse_only=AccountStrainer)
 
             # Find the span element with class "account-displayname"
             account_name_span = soup.find('div', class_='account-displayname')
@@ -43,13 +129,18 @@ class VRP_Authenticate:
             if account_name_span:
                 # Print the text content of the found span
                 print("Authenticated as:", remove_all_whitespace(account_name_span.text))
+                self.ValidatedAt = time.time()
                 return True
         print(f"Not Authenticated")
+        self.ValidatedAt = None
         return False
     
     def Authenticate(self):
+        # start from a clean jar so stale cookies dont get mixed into the new login
+        self.Session.cookies.clear()
+
         # Fetch the login page
-        response = requests.get(self.LoginURL)
+        response = self.Get(self.LoginURL)
 
         if response.status_code == 200:
             soup = BeautifulSoup(response.text, 'html.parser')
@@ -66,53 +157,90 @@ class VRP_Authenticate:
             }
 
             # Make a POST request to login
-            response = requests.post(action_url, data=data)
+            response = self.Session.post(action_url, data=data)
 
             if response.status_code == 200:
-                print("Login successful!")
+                # a rejected login is a 200 as well, only the account page can tell. it sets ValidatedAt
+                if self.IsAuthenticated():
+                    print("Login successful!")
 
-                # Print the cookies received in the response
-                print("Cookies:", response.cookies.get_dict())
-                self.Cookies = response.cookies.get_dict()
-                return True
+                    # Print the cookies received in the response
+                    print("Cookies:", self.Cookies)
+                    return True
+                print("Login failed. The account page doesnt show us logged in.")
             else:
                 print(f"Login failed. Status code: {response.status_code}")
         else:
             print(f"Failed to fetch login page. Status code: {response.status_code}")
+        self.ValidatedAt = None
         return False
 
 class VRP_VideoData:
-    def __init__(self, quality, size, link):
+    def __init__(self, quality, size, link, session=None):
         self.Quality = quality
         self.Size = size
         self.Link = link
 
-    def download_file(self, destination):
-        response = requests.get(self.Link, stream=True)
+        # parsed once here so picking a quality only compares numbers
+        self.Bytes = parse_size(size)
+        self.Height = parse_height(quality)
+        self.Session = session if session is not None else requests
+
+    def download_file(self, destination, buffer_size=1024 * 1024):
+        response = self.Session.get(self.Link, headers=StreamHeaders, stream=True)
         if response.status_code == 200:
-            with open(destination, 'wb') as file:
-                for chunk in response.iter_content(chunk_size=128):
-                    file.write(chunk)
+            with open(destination, 'wb') as file, response:
+                stream_into(response, file, bytearray(buffer_size))
             print(f"File downloaded successfully to {destination}")
         else:
             print(f"Failed to download the file. Status code: {response.status_code}")
 
-    def download_file_with_progress(self, destination):
-        response = requests.get(self.Link, stream=True)
-        total_size = int(response.headers.get('content-length', 0))
+    def download_file_with_progress(self, destination, segments=1, segment_size=64 * 1024 * 1024, buffer_size=1024 * 1024, progress=None, bandwidth=None, retry=None):
+        # split large files over several connections. falls back to one stream when ranges arent supported
+        downloader = RangeDownloader(session=self.Session, segments=segments, segment_size=segment_size, buffer_size=buffer_size, progress=progress, site="vrporn", bandwidth=bandwidth, retry=retry)
+        downloader.download(self.Link, destination)
+
+class VRP_PageCache:
+    """On disk cache of scraped video pages, one json file per url.
 
-        with open(destination, 'wb') as file, tqdm(
-            desc=destination,
-            total=total_size,
-            unit='B',
-            unit_scale=True,
-            unit_divisor=1024,
-        ) as bar:
-            for chunk in response.iter_content(chunk_size=1024):
-                file.write(chunk)
-                bar.update(len(chunk))
+    Entries younger than the ttl are used as is. Older ones are revalidated with
+    the stored ETag/Last-Modified, so an unchanged page only costs a 304.
+    A 304 doesnt make the signed download links any younger though, so once
+    the links are older than link_ttl the page is always fetched in full.
+    """
+    def __init__(self, cache_dir, ttl, link_ttl):
+        self.CacheDir = cache_dir
+        self.TTL = ttl
+        self.LinkTTL = link_ttl
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_filename(self, url):
+        return os.path.join(self.CacheDir, f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.json")
+
+    def get(self, url):
+        try:
+            with open(self.get_filename(url), 'r') as json_file:
+                entry = json.load(json_file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return None
+        return entry if entry.get('url') == url else None
 
-        print(f"File downloaded successfully to {destination}")
+    def put(self, url, entry):
+        entry['url'] = url
+        with atomic_write(self.get_filename(url)) as json_file:
+            json.dump(entry, json_file)
+
+    def remove(self, url):
+        filename = self.get_filename(url)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def is_fresh(self, entry):
+        return time.time() - entry.get('fetched_at', 0) < self.TTL and self.links_valid(entry)
+
+    def links_valid(self, entry):
+        # entries from before links_fetched_at was stored cant tell how old their links are
+        return time.time() - entry.get('links_fetched_at', 0) < self.LinkTTL
 
 class VRP_Page:
     def __init__(self, url, auth):
@@ -120,73 +248,119 @@ class VRP_Page:
         self.Auth = auth
         self.Links = []
 
-    def obtain(self):
+        # set when the page only offers logged out links, which means our session most likely expired
+        self.SessionExpired = False
+
+    def obtain(self, cache=None):
+        entry = cache.get(self.URL) if cache is not None else None
+        if entry is not None and not cache.links_valid(entry):
+            # the links may have expired even if the page didnt change, so no conditional request
+            entry = None
+        if entry is not None and cache.is_fresh(entry):
+            print(f"[vrp] Using cached page for {self.URL}")
+            self.load_entry(entry)
+            return
+
+        # ask the server if our cached copy is still good
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
         # Send an HTTP request to the webpage with the provided cookies
-        response = requests.get(self.URL, cookies=self.Auth.Cookies)
+        response = self.Auth.Get(self.URL, headers=headers)
+
+        if response.status_code == 304 and entry is not None:
+            print(f"[vrp] Page not modified, using cached copy for {self.URL}")
+            entry['fetched_at'] = time.time()
+            cache.put(self.URL, entry)
+            self.load_entry(entry)
+            return
         
         # Check if the request was successful (status code 200)
         if response.status_code == 200:
-            # Parse the HTML content of the page
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # get the video name
-            self.Name = soup.find('h1', class_='content-title').text.strip()
+            self.parse(response.text)
 
-            # get the video's studio
-            self.Author = soup.find('a', id='studio-logo').text.strip()
+            # dont cache a page that was scraped while logged out
+            if cache is not None and len(self.Links) > 0 and not self.SessionExpired:
+                fetched_at = time.time()
+                cache.put(self.URL, {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'fetched_at': fetched_at,
+                    'links_fetched_at': fetched_at,
+                    'name': self.Name,
+                    'author': self.Author,
+                    'links': [{'quality': link.Quality, 'size': link.Size, 'link': link.Link} for link in self.Links],
+                })
+        else:
+            print(f"Failed to retrieve the webpage. Status code: {response.status_code}")
 
-            # Find the div element with class "download-links-popup"
-            download_div = soup.find('div', class_='download-links-popup')
-            
-            # Check if the div element was found
-            if download_div:
+    def load_entry(self, entry):
+        self.Name = entry['name']
+        self.Author = entry['author']
+        self.Links = [VRP_VideoData(quality=link['quality'], size=link['size'], link=link['link'], session=self.Auth.Session) for link in entry['links']]
 
-                # Find the hidden "list_row" that holds all the download links
-                links_div = soup.find('div', class_='list_row')
-                list_rows = links_div.find_all('div', {'class': 'download-btn vr-download paid-download'})
-                
-                # if its 0 then we are probably a free account
-                if len(list_rows) == 0:
-                    list_rows = links_div.find_all('div', {'class': 'download-btn vr-download free-download'})
-                    
-                # scrape each link
-                for row in list_rows:
-
-                    # check for a "premium only" text
-                    premium_elemt = row.find('span', class_='text_login')
-                    if premium_elemt is not None:
-                        print("Found premium only link")
-                        continue
-
-                    # build our info
-                    link = row.attrs['data']
-                    quality = row.attrs['id']
-                    size = "0"
-
-                    # get the text for hte name and the filesize
-                    size = row.find('span', class_='right').text
-                    quality_element = row.find('span', class_='text_long')
-                    if quality_element is not None:
-                        quality = quality_element.text.replace("Max Quality ", "")
-
-                    self.Links.append(VRP_VideoData(quality=quality, size=size, link=link))
-            else:
-                print("Div element with class 'download-links-popup' not found.")
+    def parse(self, text, targeted=True):
+        # Parse the HTML content of the page. targeted only builds the elements we read below
+        if targeted:
+            soup = BeautifulSoup(text, HTMLParser, parse_only=PageStrainer())
         else:
-            print(f"Failed to retrieve the webpage. Status code: {response.status_code}")
+            soup = BeautifulSoup(text, 'html.parser')
 
-    def find_largest_under_limit(self, limit):
-        # Function to convert file size text to bytes
-        def convert_to_bytes(target_link):
-            units = {'KB': 1e3, 'MB': 1e6, 'GB': 1e9, 'TB': 1e12}
-            size, unit = target_link.split()
-            return float(size) * units[unit]
+        # get the video name
+        self.Name = soup.find('h1', class_='content-title').text.strip()
 
-        # Convert the limit to bytes
-        limit_bytes = convert_to_bytes(limit)
+        # get the video's studio
+        self.Author = soup.find('a', id='studio-logo').text.strip()
+
+        # Find the div element with class "download-links-popup"
+        download_div = soup.find('div', class_='download-links-popup')
+        
+        # Check if the div element was found
+        if download_div:
+
+            # Find the hidden "list_row" that holds all the download links
+            links_div = soup.find('div', class_='list_row')
+            list_rows = links_div.find_all('div', {'class': 'download-btn vr-download paid-download'})
+            
+            # if its 0 then we are probably a free account, or our login is no longer valid
+            if len(list_rows) == 0:
+                list_rows = links_div.find_all('div', {'class': 'download-btn vr-download free-download'})
+                self.SessionExpired = True
+                
+            # scrape each link
+            for row in list_rows:
 
-        # Filter file sizes that are under or equal to the limit
-        valid_sizes = [link for link in self.Links if convert_to_bytes(link.Size) <= limit_bytes]
+                # check for a "premium only" text
+                premium_elemt = row.find('span', class_='text_login')
+                if premium_elemt is not None:
+                    print("Found premium only link")
+                    self.SessionExpired = True
+                    continue
+
+                # build our info
+                link = row.attrs['data']
+                quality = row.attrs['id']
+                size = "0"
+
+                # get the text for hte name and the filesize
+                size = row.find('span', class_='right').text
+                quality_element = row.find('span', class_='text_long')
+                if quality_element is not None:
+                    quality = quality_element.text.replace("Max Quality ", "")
+
+                session = self.Auth.Session if self.Auth is not None else None
+                self.Links.append(VRP_VideoData(quality=quality, size=size, link=link, session=session))
+        else:
+            print("Div element with class 'download-links-popup' not found.")
+
+    def find_largest_under_limit(self, limit):
+        # the limit is in bytes or a size like "10 GB"
+        limit_bytes = parse_size(limit) if isinstance(limit, str) else limit
 
         # If there are valid sizes, return the largest one; otherwise, return None
-        return max(valid_sizes, key=lambda x: convert_to_bytes(x.Size), default=None)
+        valid_sizes = [link for link in self.Links if link.Bytes <= limit_bytes]
+        return max(valid_sizes, key=lambda x: x.Bytes, default=None)